@@ -0,0 +1,189 @@
+# Batch generation: many prompts in, one JSONL record out per finished greentext.
+#
+# Usage:
+#   python greentext_batch.py prompts.csv -o greentexts.jsonl --provider openai --concurrency 8
+#
+# Prompts can be a CSV with a "prompt" column (otherwise the first column is
+# used), JSONL with a "prompt" field, or plain text with one prompt per line.
+# The API key is read from --api-key or OPENAI_API_KEY / ANTHROPIC_API_KEY.
+# --thread-pdf / --thread-png also export every greentext as one thread file.
+
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from greentext_control import StreamController
+from greentext_engine import DEFAULT_MODELS, make_generator, run_sync
+from greentext_export import convert_thread_to_image, convert_thread_to_pdf
+from greentext_ratelimit import KeyScheduler, RateLimitedGenerator
+from greentext_render import new_post_details
+
+
+# Function to read prompts from CSV, JSONL or plain text. Raises ValueError
+# for a malformed JSONL line or a JSONL record without a "prompt" field.
+def read_prompts(text, filename=""):
+    # A byte order mark (as Excel writes) would otherwise end up in the header
+    text = text.removeprefix("\ufeff")
+    if filename.endswith(".jsonl"):
+        prompts = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"line {number} is not valid JSON: {e.msg}") from None
+                if isinstance(record, dict) and "prompt" not in record:
+                    raise ValueError(f'line {number} has no "prompt" field')
+                prompts.append(record["prompt"] if isinstance(record, dict) else str(record))
+        return prompts
+    if filename.endswith(".csv"):
+        rows = list(csv.reader(io.StringIO(text)))
+        if not rows:
+            return []
+        header = [column.strip().lower() for column in rows[0]]
+        if "prompt" in header:
+            column = header.index("prompt")
+            rows = rows[1:]
+        else:
+            column = 0
+        return [row[column] for row in rows if len(row) > column and row[column].strip()]
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+# Function to run a batch with bounded concurrency. Each record is written to
+# `out` (unless it is None) as a JSONL line as soon as its greentext finishes
+# (in completion order), and passed to `on_result` if given. Rate limiting
+# and retries belong to `generator`: wrap it in a RateLimitedGenerator on the
+# key's scheduler, as interactive requests are, so the two split one budget.
+async def run_batch(prompts, generator, out, concurrency=8, temperature=1.0, max_tokens=300, on_result=None):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(index, prompt):
+        async with semaphore:
+            record = {"index": index, "prompt": prompt, "provider": generator.provider, "model": generator.model}
+            start = time.perf_counter()
+            try:
+                chunks = [delta async for delta in generator.stream(prompt, temperature, max_tokens)]
+                record["greentext"] = "".join(chunks)
+            except Exception as e:
+                record["error"] = str(e)
+            record["seconds"] = round(time.perf_counter() - start, 3)
+            if out is not None:
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+            if on_result:
+                on_result(record)
+            return record
+
+    return await asyncio.gather(*(worker(i, prompt) for i, prompt in enumerate(prompts)))
+
+
+# Function to turn batch records into (greentext, post_info) thread entries,
+# in prompt order, skipping failed items
+def thread_entries(records):
+    for record in sorted(records, key=lambda record: record["index"]):
+        if record.get("greentext"):
+            current_time, post_id = new_post_details()
+            yield record["greentext"], f"Anonymous {current_time} {post_id}"
+
+
+# Process-wide LRU of finished batch results, bounded by their total JSON
+# size. Sessions only keep the id put() returns, so results aren't held once
+# per session, and the oldest batches are dropped when the store is full (the
+# newest one is always kept).
+class BatchStore:
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._batches = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.evictions = 0
+
+    # Function to store a batch's records; returns its id
+    def put(self, records):
+        batch_id = uuid.uuid4().hex
+        size = sum(len(json.dumps(record)) for record in records)
+        with self._lock:
+            self._batches[batch_id] = (records, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self._batches) > 1:
+                self.bytes -= self._batches.popitem(last=False)[1][1]
+                self.evictions += 1
+        return batch_id
+
+    # Function to get a batch's records, or None once it has been dropped
+    def get(self, batch_id):
+        with self._lock:
+            entry = self._batches.get(batch_id)
+            if entry is None:
+                return None
+            self._batches.move_to_end(batch_id)
+            return entry[0]
+
+    def stats(self):
+        with self._lock:
+            return {"batches": len(self._batches), "bytes": self.bytes, "evictions": self.evictions}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate greentexts for a list of prompts")
+    parser.add_argument("prompts", help="CSV, JSONL or text file of prompts")
+    parser.add_argument("-o", "--output", help="JSONL output file (default: stdout)")
+    parser.add_argument("--provider", choices=["openai", "anthropic", "fake"], default="openai")
+    parser.add_argument("--model", help="Model name (default: the app's model for the provider)")
+    parser.add_argument("--api-key", help="API key (default: <PROVIDER>_API_KEY environment variable)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--max-tokens", type=int, default=300)
+    parser.add_argument("--rpm", type=float, help="Requests per minute (default depends on provider, 0 for no limit)")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--thread-pdf", help="Also export all greentexts to this PDF file")
+    parser.add_argument("--thread-png", help="Also export all greentexts to this PNG file")
+    args = parser.parse_args()
+
+    api_key = args.api_key or os.environ.get(f"{args.provider.upper()}_API_KEY")
+    if args.provider != "fake" and not api_key:
+        parser.error(f"no API key: pass --api-key or set {args.provider.upper()}_API_KEY")
+
+    try:
+        with open(args.prompts, encoding="utf-8-sig") as f:
+            prompts = read_prompts(f.read(), args.prompts)
+    except ValueError as e:
+        parser.error(f"can't read prompts from {args.prompts}: {e}")
+
+    generator = StreamController(RateLimitedGenerator(
+        make_generator(args.provider, api_key, args.model or DEFAULT_MODELS.get(args.provider)),
+        KeyScheduler(args.provider, args.rpm),
+        args.retries
+    ))
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        records = run_sync(run_batch(
+            prompts, generator, out,
+            concurrency=args.concurrency,
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+        ))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if args.thread_pdf:
+        convert_thread_to_pdf(thread_entries(records), args.thread_pdf)
+    if args.thread_png:
+        convert_thread_to_image(list(thread_entries(records)), args.thread_png)
+
+    failed = sum(1 for record in records if "error" in record)
+    print(f"Generated {len(records) - failed}/{len(records)} greentexts", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
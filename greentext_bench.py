@@ -0,0 +1,438 @@
+# Offline benchmarks for the greentext hot paths.
+#
+# Usage:
+#   python greentext_bench.py streaming [--tokens 1000] [--rate 50]
+#   python greentext_bench.py concurrency [--sessions 50] [--delay 0.001]
+#   python greentext_bench.py ttft --provider openai [--requests 10] [--fresh-clients]
+#     (reads OPENAI_API_KEY / ANTHROPIC_API_KEY from the environment)
+#   python greentext_bench.py pdf [--lines 10 100 1000] [--repeat 5]
+#   python greentext_bench.py exports [--jobs 32] [--threads 8] [--workers 4] [--lines 200]
+#   python greentext_bench.py suite [--lines 60] [--chunk-chars 4] [--rate 0] [--replay stream.jsonl]
+#                                   [--json results.json] [--baseline baseline.json] [--max-regression 0.25]
+#   python greentext_bench.py record --provider openai --prompt "..." -o stream.jsonl
+#   python greentext_bench.py importtime [--runs 5] [--max-ms 500]
+#
+# `suite` is the CI entry point: it drives the streaming renderer, the redisplay
+# formatter and both exporters without a network, reports throughput, peak
+# traced memory and new allocations per case, and exits non-zero when a case
+# regresses past --max-regression against a saved --baseline.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from greentext_engine import FakeGenerator, ReplayGenerator, create_client, get_event_loop, iter_stream, make_generator, run_sync
+from greentext_export import convert_to_image, convert_to_pdf, convert_to_pdf_platypus
+from greentext_lines import clear_parsed_lines
+from greentext_render import StreamingRenderer, build_post_html, format_line, render_post_html
+from greentext_workers import ExportPool
+
+SAMPLE_LINES = [
+    ">be me",
+    ">24 years old",
+    ">find a mysterious USB drive in the parking lot",
+    ">plug it into my work laptop like a genius",
+    ">it's full of spreadsheets",
+    ">all of them are about me",
+    ">column F is labeled 'still hasn't noticed'",
+    ">IT guy walks past and winks",
+    ">mfw I was the audit all along",
+]
+
+
+# Stand-in for a Streamlit placeholder that counts what would hit the websocket
+class CountingContainer:
+    def __init__(self):
+        self.calls = 0
+        self.bytes_sent = 0
+
+    def markdown(self, body, unsafe_allow_html=False):
+        self.calls += 1
+        self.bytes_sent += len(body.encode("utf-8"))
+
+
+# Function to build a synthetic token stream of roughly n_tokens chunks
+def synthetic_tokens(n_tokens, chunk_chars=4, seed=0):
+    rng = random.Random(seed)
+    text = ""
+    while len(text) < n_tokens * chunk_chars:
+        text += rng.choice(SAMPLE_LINES) + "\n"
+    text = text[:n_tokens * chunk_chars]
+    return [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+
+
+# The original per-token loop: re-split and re-send the whole post every token
+def render_legacy(tokens, container, current_time, post_id):
+    full_response = ""
+    for content in tokens:
+        full_response += content
+        formatted_lines = []
+        for line in full_response.split('\n'):
+            formatted = format_line(line)
+            if formatted is not None:
+                formatted_lines.append(formatted)
+        container.markdown(build_post_html(current_time, post_id, "\n".join(formatted_lines)), unsafe_allow_html=True)
+    return full_response
+
+
+def render_incremental(tokens, container, current_time, post_id, rate):
+    # Simulated clock so time-based flushing behaves as if tokens arrived at `rate`/s
+    now = [0.0]
+    renderer = StreamingRenderer(container, current_time, post_id, clock=lambda: now[0])
+    for content in tokens:
+        now[0] += 1.0 / rate
+        renderer.feed(content)
+    return renderer.close()
+
+
+def bench_streaming(args):
+    current_time = "01/01/25(Wed)12:00:00"
+    post_id = "No.123456789"
+    print(f"{'tokens':>7} {'path':<12} {'cpu ms':>9} {'flushes':>8} {'bytes sent':>12}")
+    for n_tokens in args.tokens:
+        tokens = synthetic_tokens(n_tokens)
+        for name, run in (
+            ("legacy", lambda c: render_legacy(tokens, c, current_time, post_id)),
+            ("incremental", lambda c: render_incremental(tokens, c, current_time, post_id, args.rate)),
+        ):
+            container = CountingContainer()
+            start = time.process_time()
+            run(container)
+            cpu_ms = (time.process_time() - start) * 1000
+            print(f"{n_tokens:>7} {name:<12} {cpu_ms:>9.2f} {container.calls:>8} {container.bytes_sent:>12}")
+
+
+# Many fake sessions sharing the engine loop vs. one script thread per session
+# draining its stream serially
+def bench_concurrency(args):
+    generator = FakeGenerator(delay=args.delay)
+
+    start = time.perf_counter()
+    for _ in range(args.sessions):
+        for _ in iter_stream(generator.stream("serial", 1.0, args.tokens)):
+            pass
+    serial = time.perf_counter() - start
+
+    async def drain():
+        async for _ in generator.stream("concurrent", 1.0, args.tokens):
+            pass
+
+    async def run_all():
+        await asyncio.gather(*(drain() for _ in range(args.sessions)))
+
+    start = time.perf_counter()
+    asyncio.run_coroutine_threadsafe(run_all(), get_event_loop()).result()
+    concurrent = time.perf_counter() - start
+
+    print(f"{args.sessions} sessions, serial: {serial:.3f}s, shared loop: {concurrent:.3f}s")
+
+
+# Time-to-first-token against a real provider, with a fresh client per request
+# (the old behaviour) or the pooled client registry
+def bench_ttft(args):
+    api_key = os.environ[f"{args.provider.upper()}_API_KEY"]
+
+    async def first_token(generator):
+        start = time.perf_counter()
+        agen = generator.stream("be me, benchmarking", 0.0, 16)
+        try:
+            async for _ in agen:
+                return time.perf_counter() - start
+        finally:
+            await agen.aclose()
+
+    samples = []
+    for _ in range(args.requests):
+        generator = make_generator(args.provider, api_key)
+        if args.fresh_clients:
+            generator.client = create_client(args.provider, api_key)
+        samples.append(run_sync(first_token(generator)))
+        if args.fresh_clients:
+            run_sync(generator.client.close())
+
+    mode = "fresh clients" if args.fresh_clients else "pooled client"
+    print(f"{args.provider} TTFT ({mode}, {len(samples)} requests): "
+          f"first {samples[0] * 1000:.0f}ms, p50 {statistics.median(samples) * 1000:.0f}ms, "
+          f"max {max(samples) * 1000:.0f}ms")
+
+
+# PDF export time, canvas backend vs the Platypus layout
+def bench_pdf(args):
+    post_info = "Anonymous 01/01/25(Wed)12:00:00 No.123456789"
+    print(f"{'lines':>6} {'platypus ms':>12} {'canvas ms':>10} {'speedup':>8}")
+    for n_lines in args.lines:
+        greentext = "\n".join(SAMPLE_LINES[i % len(SAMPLE_LINES)] for i in range(n_lines))
+        timings = []
+        for convert in (convert_to_pdf_platypus, convert_to_pdf):
+            convert(greentext, post_info)  # warm caches
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                convert(greentext, post_info)
+            timings.append((time.perf_counter() - start) / args.repeat * 1000)
+        print(f"{n_lines:>6} {timings[0]:>12.2f} {timings[1]:>10.2f} {timings[0] / timings[1]:>7.1f}x")
+
+
+# Export throughput from concurrent sessions, rendering inline vs in the export
+# worker pool, and the worst stall seen by a thread that wakes every 10ms (a
+# stand-in for other sessions' reruns waiting on the GIL)
+def bench_exports(args):
+    from concurrent.futures import ThreadPoolExecutor
+
+    greentext = "\n".join(SAMPLE_LINES[i % len(SAMPLE_LINES)] for i in range(args.lines))
+    formats = ["png", "pdf"]
+    print(f"{'mode':>8} {'jobs/s':>8} {'max stall ms':>13}")
+    for workers in (0, args.workers):
+        pool = ExportPool(workers=workers, max_pending=args.jobs)
+        pool.export(greentext, "warmup", "png")
+        stalls = []
+        done = False
+
+        def heartbeat():
+            last = time.perf_counter()
+            while not done:
+                time.sleep(0.01)
+                now = time.perf_counter()
+                stalls.append(now - last - 0.01)
+                last = now
+
+        ticker = ThreadPoolExecutor(1)
+        ticker.submit(heartbeat)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as sessions:
+            list(sessions.map(
+                lambda i: pool.export(greentext, f"Anonymous No.{i}", formats[i % len(formats)]), range(args.jobs)
+            ))
+        elapsed = time.perf_counter() - start
+        done = True
+        ticker.shutdown()
+        pool.shutdown()
+        mode = f"{workers} procs" if workers else "inline"
+        print(f"{mode:>8} {args.jobs / elapsed:>8.1f} {max(stalls) * 1000:>13.1f}")
+
+
+# Function to time `case` over `repeat` runs and trace one extra run's memory.
+# `case` returns the number of units (characters) it processed.
+def measure(case, repeat):
+    case()  # warm caches and imports
+    start = time.perf_counter()
+    units = 0
+    for _ in range(repeat):
+        units += case()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    case()
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    new_blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+
+    return {
+        "ms_per_run": elapsed / repeat * 1000,
+        "units_per_second": units / elapsed if elapsed else 0.0,
+        "peak_kib": peak / 1024,
+        "new_blocks": new_blocks,
+    }
+
+
+def bench_suite(args):
+    post_info = "Anonymous 01/01/25(Wed)12:00:00 No.123456789"
+    if args.replay:
+        replay = ReplayGenerator.from_jsonl(args.replay, speed=args.speed)
+    else:
+        tokens = synthetic_tokens(args.lines * 40 // args.chunk_chars, args.chunk_chars)
+        delay = 1.0 / args.rate if args.rate else 0.0
+        replay = ReplayGenerator([(delay, token) for token in tokens])
+    text = "".join(token for _, token in replay.deltas)
+
+    def stream_render():
+        renderer = StreamingRenderer(CountingContainer(), "01/01/25(Wed)12:00:00", "No.123456789")
+        for delta in iter_stream(replay.stream("bench", 1.0, len(replay.deltas))):
+            renderer.feed(delta)
+        return len(renderer.close())
+
+    def format_post():
+        # Parse from scratch every run rather than time a lookup of the lines
+        # remembered by the previous one
+        clear_parsed_lines()
+        render_post_html(text, "01/01/25(Wed)12:00:00", "No.123456789")
+        return len(text)
+
+    def export_png():
+        convert_to_image(text, post_info)
+        return len(text)
+
+    def export_pdf():
+        convert_to_pdf(text, post_info)
+        return len(text)
+
+    cases = {
+        "stream_render": stream_render,
+        "format_post": format_post,
+        "export_png": export_png,
+        "export_pdf": export_pdf,
+    }
+    results = {name: measure(case, args.repeat) for name, case in cases.items()}
+
+    print(f"{len(replay.deltas)} chunks, {len(text)} chars")
+    print(f"{'case':<14} {'ms/run':>9} {'chars/s':>12} {'peak KiB':>10} {'new blocks':>11}")
+    for name, result in results.items():
+        print(f"{name:<14} {result['ms_per_run']:>9.2f} {result['units_per_second']:>12.0f} "
+              f"{result['peak_kib']:>10.1f} {result['new_blocks']:>11}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = []
+        for name, result in results.items():
+            base = baseline.get(name)
+            if not base:
+                continue
+            if result["units_per_second"] < base["units_per_second"] * (1 - args.max_regression):
+                failures.append(f"{name}: throughput {result['units_per_second']:.0f} < baseline {base['units_per_second']:.0f}")
+            if result["peak_kib"] > base["peak_kib"] * (1 + args.max_regression):
+                failures.append(f"{name}: peak memory {result['peak_kib']:.1f} KiB > baseline {base['peak_kib']:.1f} KiB")
+        for failure in failures:
+            print(f"REGRESSION {failure}", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+
+# Record a real provider stream (with inter-chunk timing) for replay by `suite`
+def bench_record(args):
+    api_key = os.environ[f"{args.provider.upper()}_API_KEY"]
+    generator = make_generator(args.provider, api_key)
+    last = time.perf_counter()
+    with open(args.output, "w", encoding="utf-8") as f:
+        for delta in iter_stream(generator.stream(args.prompt, args.temperature, args.max_tokens)):
+            now = time.perf_counter()
+            f.write(json.dumps({"delay": round(now - last, 6), "text": delta}) + "\n")
+            last = now
+
+
+# Modules a fresh app process imports before its first render, and the heavy
+# libraries none of them may import eagerly
+COLD_START_MODULES = [
+    "greentext_render", "greentext_engine", "greentext_cache", "greentext_coalesce",
+    "greentext_metrics", "greentext_export", "greentext_keys", "greentext_batch",
+    "greentext_workers",
+]
+LAZY_MODULES = ["openai", "anthropic", "httpx", "httpx2", "PIL", "reportlab", "cryptography"]
+
+
+# Cold-start import cost from `python -X importtime` in fresh interpreters.
+# Fails if a lazily imported library shows up or the median exceeds --max-ms.
+def bench_importtime(args):
+    code = "import " + ", ".join(args.modules)
+    cumulative = {}
+    totals = []
+    for _ in range(args.runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        run = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative_us, name = line[len("import time:"):].split("|")
+            if not cumulative_us.strip().isdigit():
+                continue
+            run[name.strip()] = int(cumulative_us)
+        for name, micros in run.items():
+            cumulative.setdefault(name, []).append(micros)
+        totals.append(sum(run.get(module, 0) for module in args.modules) / 1000)
+
+    print(f"{'module':<24} {'median ms':>10}")
+    for module in args.modules:
+        print(f"{module:<24} {statistics.median(cumulative.get(module, [0])) / 1000:>10.1f}")
+    median_total = statistics.median(totals)
+    print(f"{'total':<24} {median_total:>10.1f}")
+
+    failures = [name for name in LAZY_MODULES if name in cumulative]
+    for name in failures:
+        print(f"REGRESSION {name} is imported at startup", file=sys.stderr)
+    if args.max_ms and median_total > args.max_ms:
+        print(f"REGRESSION cold-start imports took {median_total:.1f}ms > {args.max_ms}ms", file=sys.stderr)
+        failures.append("total")
+    if failures:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Greentext performance benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    streaming = sub.add_parser("streaming", help="Stream rendering CPU and bytes sent, legacy vs incremental")
+    streaming.add_argument("--tokens", type=int, nargs="+", default=[100, 300, 1000])
+    streaming.add_argument("--rate", type=float, default=50.0, help="Simulated tokens per second")
+    streaming.set_defaults(func=bench_streaming)
+
+    concurrency = sub.add_parser("concurrency", help="Concurrent fake sessions on the shared engine loop")
+    concurrency.add_argument("--sessions", type=int, default=50)
+    concurrency.add_argument("--tokens", type=int, default=300)
+    concurrency.add_argument("--delay", type=float, default=0.001, help="Seconds between fake chunks")
+    concurrency.set_defaults(func=bench_concurrency)
+
+    ttft = sub.add_parser("ttft", help="Time-to-first-token against a real provider")
+    ttft.add_argument("--provider", choices=["openai", "anthropic"], default="openai")
+    ttft.add_argument("--requests", type=int, default=10)
+    ttft.add_argument("--fresh-clients", action="store_true", help="Build a new client per request")
+    ttft.set_defaults(func=bench_ttft)
+
+    pdf = sub.add_parser("pdf", help="PDF export time, canvas vs Platypus")
+    pdf.add_argument("--lines", type=int, nargs="+", default=[10, 100, 1000])
+    pdf.add_argument("--repeat", type=int, default=5)
+    pdf.set_defaults(func=bench_pdf)
+
+    exports = sub.add_parser("exports", help="Concurrent export throughput, inline vs worker pool")
+    exports.add_argument("--jobs", type=int, default=32)
+    exports.add_argument("--threads", type=int, default=8, help="Concurrent sessions exporting")
+    exports.add_argument("--workers", type=int, default=4, help="Export worker processes")
+    exports.add_argument("--lines", type=int, default=200)
+    exports.set_defaults(func=bench_exports)
+
+    suite = sub.add_parser("suite", help="Offline hot-path suite with memory tracing and regression checks")
+    suite.add_argument("--lines", type=int, default=60, help="Approximate output length in lines")
+    suite.add_argument("--chunk-chars", type=int, default=4, help="Characters per synthetic chunk")
+    suite.add_argument("--rate", type=float, default=0.0, help="Synthetic chunks per second (0 = unthrottled)")
+    suite.add_argument("--replay", help="Replay a stream recorded with the record command instead")
+    suite.add_argument("--speed", type=float, default=0.0, help="Replay timing multiplier (0 = no delays)")
+    suite.add_argument("--repeat", type=int, default=5)
+    suite.add_argument("--json", help="Write results to this file")
+    suite.add_argument("--baseline", help="Compare against results saved with --json")
+    suite.add_argument("--max-regression", type=float, default=0.25)
+    suite.set_defaults(func=bench_suite)
+
+    record = sub.add_parser("record", help="Record a real provider stream for replay")
+    record.add_argument("--provider", choices=["openai", "anthropic"], default="openai")
+    record.add_argument("--prompt", default="be me, finding a mysterious USB drive")
+    record.add_argument("--temperature", type=float, default=1.0)
+    record.add_argument("--max-tokens", type=int, default=300)
+    record.add_argument("-o", "--output", required=True)
+    record.set_defaults(func=bench_record)
+
+    importtime = sub.add_parser("importtime", help="Cold-start import time of the app modules")
+    importtime.add_argument("--runs", type=int, default=5)
+    importtime.add_argument("--max-ms", type=float, default=0.0, help="Fail if the median total exceeds this")
+    importtime.add_argument("--modules", nargs="+", default=COLD_START_MODULES)
+    importtime.set_defaults(func=bench_importtime)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
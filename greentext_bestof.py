@@ -0,0 +1,95 @@
+# Best-of-N generation: several candidate streams for one prompt, run
+# concurrently, with the winner picked by a cheap local score.
+#
+# best_of_n() is an async generator of events so the caller can show every
+# candidate live:
+#   ("delta", index, text)       a chunk of candidate `index`
+#   ("finished", index, score)   candidate `index` completed with this score
+#   ("error", index, error)      candidate `index` failed
+#   ("cancelled", index, None)   candidate `index` was stopped as a loser
+#   ("winner", index, text)      last event: the chosen candidate and its text
+# A winner is decided as soon as a finished candidate scores at least
+# `good_enough`, or once `quorum` candidates have finished (half of them by
+# default); the candidates still streaming are cancelled at that point, which
+# closes their upstream provider streams.
+#
+# Candidates must not share a CoalescingGenerator: identical concurrent
+# requests would be merged into one stream.
+
+import asyncio
+
+from greentext_lines import REACTION_PREFIXES, parse_lines
+from greentext_metrics import metrics
+
+# Score that wins outright (a compliant post of five or more lines)
+GOOD_ENOUGH = 0.95
+# Posts shorter than this many lines score lower on length
+MIN_GOOD_LINES = 6
+MAX_LINE_WORDS = 15
+
+
+# Function to score a greentext between 0 and 1 from its line records
+# (greentext_lines.parse_lines, so the winner's lines are already parsed when
+# it is shown): share of lines the model already wrote in '>' format, share of
+# short lines, a closing reaction line and enough lines to tell a story
+def score_greentext(text):
+    lines = parse_lines(text)
+    if not lines:
+        return 0.0
+    # Records all carry the marker; count the lines that came with it
+    marked = text.lstrip().startswith('>') + text.count('\n>')
+    formatted = min(1.0, marked / len(lines))
+    short = sum(len(line.text.split()) <= MAX_LINE_WORDS for line in lines) / len(lines)
+    reaction = 1.0 if any(line.text.lower().startswith(REACTION_PREFIXES) for line in lines[-2:]) else 0.0
+    length = min(1.0, len(lines) / MIN_GOOD_LINES)
+    return round(0.4 * formatted + 0.2 * short + 0.2 * reaction + 0.2 * length, 3)
+
+
+async def best_of_n(generator, prompt, temperature, max_tokens, n, good_enough=GOOD_ENOUGH, quorum=None):
+    quorum = quorum or (n + 1) // 2
+    labels = {"provider": generator.provider, "model": generator.model}
+    events = asyncio.Queue()
+    texts = [[] for _ in range(n)]
+
+    async def run(index):
+        try:
+            async for delta in generator.stream(prompt, temperature, max_tokens):
+                texts[index].append(delta)
+                events.put_nowait(("delta", index, delta))
+        except Exception as e:
+            events.put_nowait(("error", index, e))
+            return
+        events.put_nowait(("finished", index, None))
+
+    tasks = [asyncio.create_task(run(index)) for index in range(n)]
+    scores = {}
+    errors = []
+    cancelled = []
+    decided = False
+    try:
+        # Until decided, wait for every candidate to finish or fail; after
+        # that, the losers are cancelled and only what already arrived is passed on
+        while not (events.empty() if decided else len(scores) + len(errors) == n):
+            kind, index, payload = await events.get()
+            if kind == "finished":
+                payload = scores[index] = score_greentext("".join(texts[index]))
+                metrics.observe("greentext_candidate_score", payload, **labels)
+            elif kind == "error":
+                errors.append(payload)
+            yield kind, index, payload
+            if not decided and scores and (max(scores.values()) >= good_enough or len(scores) >= quorum):
+                decided = True
+                cancelled = [index for index, task in enumerate(tasks) if not task.done()]
+                for index in cancelled:
+                    tasks[index].cancel()
+                    metrics.inc("greentext_candidates_cancelled_total", **labels)
+
+        if not scores:
+            raise errors[0]
+        for index in cancelled:
+            yield "cancelled", index, None
+        winner = max(scores, key=scores.get)
+        yield "winner", winner, "".join(texts[winner])
+    finally:
+        for task in tasks:
+            task.cancel()
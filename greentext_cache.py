@@ -0,0 +1,203 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from greentext_engine import GreentextGenerator
+
+
+# Function to fingerprint the API key(s) a request is made with, so cached and
+# coalesced responses are only shared between callers using the same keys
+def tenant_fingerprint(*api_keys):
+    return hashlib.sha256("\n".join(sorted(key for key in api_keys if key)).encode()).hexdigest()
+
+
+# Function to build a content-addressed key for a generation request. `tenant`
+# is the tenant_fingerprint() of the caller's API keys.
+def generation_key(system_prompt, prompt, model, temperature, max_tokens, tenant=""):
+    payload = json.dumps({
+        "system": system_prompt,
+        "prompt": prompt,
+        "model": model,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "tenant": tenant,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# Two-tier cache of finished generations: an in-memory LRU in front of an
+# optional SQLite file. Entries in either tier expire `ttl` seconds after they
+# were generated, and the table is trimmed to `max_db_entries` by least-recent
+# access.
+class GenerationCache:
+    def __init__(self, max_entries=256, db_path=None, ttl=7 * 24 * 3600, max_db_entries=10000, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self.max_db_entries = max_db_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS generations ("
+                "key TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS generations_accessed ON generations (accessed)")
+            self._db.commit()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                text, created = entry
+                if self._clock() - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return text
+                del self._memory[key]
+            entry = self._get_disk(key)
+            if entry is not None:
+                text, created = entry
+                self._put_memory(key, text, created)
+                self.hits += 1
+                self.disk_hits += 1
+                return text
+            self.misses += 1
+            return None
+
+    def put(self, key, text):
+        with self._lock:
+            now = self._clock()
+            self._put_memory(key, text, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO generations (key, text, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, text, now, now)
+                )
+                self._db.execute(
+                    "DELETE FROM generations WHERE key IN ("
+                    "SELECT key FROM generations ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_db_entries,)
+                )
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "memory_entries": len(self._memory),
+            }
+
+    def _put_memory(self, key, text, created):
+        self._memory[key] = (text, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _get_disk(self, key):
+        if self._db is None:
+            return None
+        now = self._clock()
+        row = self._db.execute("SELECT text, created FROM generations WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self.ttl:
+            self._db.execute("DELETE FROM generations WHERE key = ?", (key,))
+            self._db.commit()
+            return None
+        self._db.execute("UPDATE generations SET accessed = ? WHERE key = ?", (now, key))
+        self._db.commit()
+        return row[0], row[1]
+
+
+# Generator wrapper that serves deterministic (temperature 0) requests from
+# the cache. Hits are replayed as deltas through the same streaming path as a
+# live response; misses are streamed upstream and stored once complete.
+# Entries are scoped to `tenant` (a tenant_fingerprint), so a response paid for
+# with one API key is never served to a caller holding a different one.
+class CachedGenerator(GreentextGenerator):
+    def __init__(self, inner, cache, tenant="", replay_chunk_chars=64):
+        super().__init__(inner.model, inner.system_prompt)
+        self.provider = inner.provider
+        self.inner = inner
+        self.cache = cache
+        self.tenant = tenant
+        self.replay_chunk_chars = replay_chunk_chars
+
+    async def stream(self, prompt, temperature, max_tokens):
+        if temperature != 0:
+            async for delta in self.inner.stream(prompt, temperature, max_tokens):
+                yield delta
+            return
+
+        key = generation_key(self.system_prompt, prompt, f"{self.provider}/{self.model}", temperature, max_tokens, self.tenant)
+        text = self.cache.get(key)
+        if text is not None:
+            for i in range(0, len(text), self.replay_chunk_chars):
+                yield text[i:i + self.replay_chunk_chars]
+            return
+
+        chunks = []
+        async for delta in self.inner.stream(prompt, temperature, max_tokens):
+            chunks.append(delta)
+            yield delta
+        self.cache.put(key, "".join(chunks))
+
+
+# Process-wide LRU of rendered export bytes (images, PDFs), bounded by total
+# size rather than entry count. Sessions share it, so a session only keeps the
+# key of an export and identical posts are rendered once per process.
+class ExportCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Function to return cached bytes for `key`, calling build() on a miss.
+    # build() runs outside the lock, so a rare duplicate render is possible.
+    def get_or_build(self, key, build):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        data = build()
+        if len(data) <= self.max_bytes:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = data
+                    self.bytes += len(data)
+                while self.bytes > self.max_bytes:
+                    self.bytes -= len(self._entries.popitem(last=False)[1])
+                    self.evictions += 1
+        return data
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
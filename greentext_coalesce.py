@@ -0,0 +1,88 @@
+import asyncio
+
+from greentext_cache import generation_key
+from greentext_engine import GreentextGenerator
+from greentext_metrics import metrics
+
+
+# One in-flight upstream stream and the chunks it has produced so far
+class _Flight:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.changed = asyncio.Condition()
+        self.task = None
+
+
+# In-flight streams by (event loop, request key), shared by every
+# CoalescingGenerator in the process
+_flights = {}
+
+
+# Generator wrapper that deduplicates concurrent identical requests. The first
+# request for a given (system prompt, prompt, provider/model, temperature,
+# max_tokens) starts the upstream stream; identical requests that arrive while
+# it is running subscribe to it instead, replaying the chunks buffered so far
+# and then following along live. The upstream stream is cancelled only when
+# every subscriber has gone away. Only callers with the same `tenant` (a
+# greentext_cache.tenant_fingerprint of their API keys) share a stream, so an
+# unchecked or someone else's key never rides on another caller's request.
+class CoalescingGenerator(GreentextGenerator):
+    def __init__(self, inner, tenant="", flights=_flights):
+        super().__init__(inner.model, inner.system_prompt)
+        self.provider = inner.provider
+        self.inner = inner
+        self.tenant = tenant
+        self.flights = flights
+
+    async def stream(self, prompt, temperature, max_tokens):
+        key = (
+            id(asyncio.get_running_loop()),
+            generation_key(self.system_prompt, prompt, f"{self.provider}/{self.model}", temperature, max_tokens, self.tenant),
+        )
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self.flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, prompt, temperature, max_tokens))
+        else:
+            metrics.inc("greentext_coalesced_total", provider=self.provider, model=self.model)
+
+        flight.subscribers += 1
+        position = 0
+        try:
+            while True:
+                async with flight.changed:
+                    await flight.changed.wait_for(lambda: position < len(flight.chunks) or flight.done)
+                    new_chunks = flight.chunks[position:]
+                    finished = flight.done
+                position += len(new_chunks)
+                for chunk in new_chunks:
+                    yield chunk
+                if finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                flight.task.cancel()
+
+    async def _run(self, key, flight, prompt, temperature, max_tokens):
+        try:
+            async for delta in self.inner.stream(prompt, temperature, max_tokens):
+                async with flight.changed:
+                    flight.chunks.append(delta)
+                    flight.changed.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            flight.done = True
+            async with flight.changed:
+                flight.changed.notify_all()
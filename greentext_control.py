@@ -0,0 +1,111 @@
+# Early stopping for streamed greentexts.
+#
+# StreamController watches the normalized lines of a stream as they complete
+# and stops it as soon as one of its rules is met:
+#   max_lines            the post has this many (non-blank) lines
+#   max_line_chars       the current (normalized) line runs past this many
+#                        characters (the model has left greentext format; the
+#                        line is cut there)
+#   stop_after_reaction  a closing reaction line (">mfw ...", ">tfw ...") has
+#                        completed (greentext_lines.REACTION_PREFIXES)
+# Stopping closes the upstream generator; every wrapper below closes its own
+# inner stream in turn (refunding rate-limit budget and recording stream
+# metrics on the way), down to the OpenAI/Anthropic stream and its HTTP
+# response, so the provider stops generating.
+#
+# Each stop is counted in greentext_early_stops_total{rule} with estimates of
+# what it saved: the unused completion budget in tokens (an upper bound, at
+# ~4 characters per token) and the time the stream would have taken to spend
+# it at the rate observed so far.
+#
+# Every rule is off by default, since each one can cut a legitimate post
+# short: a long story, a long line or a reaction line before the end. They
+# are turned on with GREENTEXT_MAX_LINES, GREENTEXT_MAX_LINE_CHARS (0 = off)
+# and GREENTEXT_STOP_AFTER_REACTION (1 = on). They are process-wide settings,
+# so cached and coalesced responses always follow the same rules.
+
+import os
+import time
+
+from greentext_engine import GreentextGenerator
+from greentext_lines import REACTION_PREFIXES, LineParser
+from greentext_metrics import metrics
+
+MAX_LINES = int(os.environ.get("GREENTEXT_MAX_LINES", "0"))
+MAX_LINE_CHARS = int(os.environ.get("GREENTEXT_MAX_LINE_CHARS", "0"))
+STOP_AFTER_REACTION = os.environ.get("GREENTEXT_STOP_AFTER_REACTION", "0") == "1"
+
+
+# Per-stream line tracking on a greentext_lines.LineParser: scan() reports
+# where a delta has to be cut when it completes a rule, or (None, None) to
+# keep all of it. Deltas are fed up to each newline so a cut lands on the
+# line that triggered it; max_line_chars applies to the normalized open line.
+class _LineWatch:
+    def __init__(self, controller):
+        self.controller = controller
+        self.parser = LineParser()
+
+    def scan(self, delta):
+        controller = self.controller
+        start = 0
+        while start < len(delta):
+            newline = delta.find('\n', start)
+            end = len(delta) if newline == -1 else newline
+            self.parser.feed(delta[start:end])
+            if controller.max_line_chars:
+                partial = self.parser.partial()
+                overflow = len(partial.text) - controller.max_line_chars if partial else 0
+                if overflow > 0:
+                    return max(start, end - overflow), "max_line_chars"
+            if newline == -1:
+                break
+            start = newline + 1
+            for record in self.parser.feed('\n'):
+                if controller.stop_after_reaction and record.text.lower().startswith(REACTION_PREFIXES):
+                    return start, "reaction"
+                if controller.max_lines and len(self.parser.lines) >= controller.max_lines:
+                    return start, "max_lines"
+        return None, None
+
+
+class StreamController(GreentextGenerator):
+    def __init__(self, inner, max_lines=MAX_LINES, max_line_chars=MAX_LINE_CHARS,
+                 stop_after_reaction=STOP_AFTER_REACTION, registry=metrics):
+        super().__init__(inner.model, inner.system_prompt)
+        self.provider = inner.provider
+        self.inner = inner
+        self.max_lines = max_lines
+        self.max_line_chars = max_line_chars
+        self.stop_after_reaction = stop_after_reaction
+        self.registry = registry
+
+    async def stream(self, prompt, temperature, max_tokens):
+        watch = _LineWatch(self)
+        deltas = self.inner.stream(prompt, temperature, max_tokens)
+        chars = 0
+        first_delta_at = None
+        try:
+            async for delta in deltas:
+                if first_delta_at is None:
+                    first_delta_at = time.perf_counter()
+                cut, rule = watch.scan(delta)
+                if cut is not None:
+                    delta = delta[:cut]
+                if delta:
+                    chars += len(delta)
+                    yield delta
+                if rule is not None:
+                    self._record_stop(rule, chars, max_tokens, time.perf_counter() - first_delta_at)
+                    return
+        finally:
+            await deltas.aclose()
+
+    def _record_stop(self, rule, chars, max_tokens, streaming_seconds):
+        labels = {"provider": self.provider, "model": self.model, "rule": rule}
+        tokens_used = chars / 4
+        tokens_saved = max(0.0, max_tokens - tokens_used)
+        self.registry.inc("greentext_early_stops_total", **labels)
+        self.registry.observe("greentext_tokens_saved_estimate", tokens_saved, **labels)
+        if tokens_used and streaming_seconds > 0:
+            seconds_saved = tokens_saved / (tokens_used / streaming_seconds)
+            self.registry.observe("greentext_seconds_saved_estimate", seconds_saved, **labels)
@@ -0,0 +1,326 @@
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+from collections import OrderedDict
+
+# System prompt for greentext
+GREENTEXT_SYSTEM_PROMPT = (
+    "You are creating authentic 4chan greentext stories. "
+    "Follow these rules exactly:\n"
+    "1. Every line MUST start with '>' (no space after >)\n"
+    "2. First line should typically be '>be me' or similar\n"
+    "3. Keep lines very short - rarely more than 10-15 words\n"
+    "4. Use 4chan terminology: anon, mfw (my face when), tfw (that feel when), etc.\n"
+    "5. Be edgy, self-deprecating, and include twist endings\n"
+    "6. No paragraph breaks - just line breaks\n"
+    "7. Include at least one reaction line like '>mfw' at the end\n"
+    "8. Keep content edgy, absurd and vulgar - this is 4chan style\n"
+    "DO NOT include anything except the greentext lines. Do not explain or preface."
+)
+
+# Default model per provider
+DEFAULT_MODELS = {
+    "openai": "gpt-4.5-preview",
+    "anthropic": "claude-3-5-sonnet-20240620",
+}
+
+# Client pool settings. Idle keep-alive connections are held long enough to
+# survive the gap between reruns instead of httpx's default 5 seconds.
+CLIENT_POOL_SIZE = int(os.environ.get("GREENTEXT_CLIENT_POOL_SIZE", "32"))
+KEEPALIVE_EXPIRY = float(os.environ.get("GREENTEXT_KEEPALIVE_EXPIRY", "90"))
+# Evicted clients are closed after this many seconds so in-flight streams finish
+CLIENT_CLOSE_GRACE = 120.0
+
+
+# Function to build an SDK's own default async HTTP client with our pool
+# limits. Depending on the version, an SDK is built on httpx or httpx2 and
+# rejects clients from the other package, so Limits is taken from whichever
+# package the SDK's client class comes from.
+def _pooled_http_client(client_class):
+    http_package = sys.modules[client_class.__mro__[1].__module__.split(".")[0]]
+    return client_class(
+        limits=http_package.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=KEEPALIVE_EXPIRY)
+    )
+
+
+# Function to build a new async SDK client with its own connection pool.
+# The SDKs are imported here, on first use, rather than at module import:
+# together they take seconds to import and a session only ever needs one.
+# The SDKs' own retries are off; greentext_ratelimit.RateLimitedGenerator
+# retries against the key's budget instead.
+def create_client(provider, api_key):
+    if provider == "openai":
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        return AsyncOpenAI(api_key=api_key, max_retries=0, http_client=_pooled_http_client(DefaultAsyncHttpxClient))
+    if provider == "anthropic":
+        from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+        return AsyncAnthropic(api_key=api_key, max_retries=0, http_client=_pooled_http_client(DefaultAsyncHttpxClient))
+    raise ValueError(f"Unknown provider: {provider}")
+
+
+# Process-wide, size-bounded LRU of SDK clients keyed by (provider, key hash,
+# event loop), so reruns and sessions using the same key share one connection
+# pool and skip repeated TLS setup. Raw keys are never used as dictionary keys.
+# A client's connections belong to the loop it streams on (the shared engine
+# loop, or uvicorn's in the server), so each loop gets its own clients and an
+# evicted client is closed on its own loop.
+class ClientRegistry:
+    def __init__(self, maxsize=CLIENT_POOL_SIZE, factory=create_client):
+        self.maxsize = maxsize
+        self.factory = factory
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(provider, api_key):
+        return provider, hashlib.sha256(api_key.encode()).hexdigest()
+
+    def get(self, provider, api_key):
+        loop = _client_loop()
+        key = (*self.key_for(provider, api_key), loop)
+        evicted = []
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+            client = self.factory(provider, api_key)
+            self._clients[key] = client
+            while len(self._clients) > self.maxsize:
+                evicted.append(self._clients.popitem(last=False))
+        for old_key, old in evicted:
+            _close_later(old, old_key[-1])
+        return client
+
+    def clear(self):
+        with self._lock:
+            clients = list(self._clients.items())
+            self._clients.clear()
+        for key, client in clients:
+            _close_later(client, key[-1])
+
+    def __len__(self):
+        return len(self._clients)
+
+
+# Base class for a provider. stream() is an async generator of text deltas.
+# on_headers, when set, is called with each response's HTTP headers (used by
+# greentext_ratelimit to follow the provider's rate-limit headers).
+class GreentextGenerator:
+    provider = ""
+    on_headers = None
+
+    def __init__(self, model, system_prompt=GREENTEXT_SYSTEM_PROMPT):
+        self.model = model
+        self.system_prompt = system_prompt
+
+    async def stream(self, prompt, temperature, max_tokens):
+        raise NotImplementedError
+        yield
+
+
+class OpenAIGenerator(GreentextGenerator):
+    provider = "openai"
+
+    def __init__(self, api_key, model=DEFAULT_MODELS["openai"], system_prompt=GREENTEXT_SYSTEM_PROMPT, client=None):
+        super().__init__(model, system_prompt)
+        self.client = client or client_registry.get("openai", api_key)
+
+    async def stream(self, prompt, temperature, max_tokens):
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True
+        )
+        if self.on_headers:
+            self.on_headers(stream.response.headers)
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+
+class AnthropicGenerator(GreentextGenerator):
+    provider = "anthropic"
+
+    def __init__(self, api_key, model=DEFAULT_MODELS["anthropic"], system_prompt=GREENTEXT_SYSTEM_PROMPT, client=None):
+        super().__init__(model, system_prompt)
+        self.client = client or client_registry.get("anthropic", api_key)
+
+    async def stream(self, prompt, temperature, max_tokens):
+        async with self.client.messages.stream(
+            model=self.model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            system=self.system_prompt,
+            messages=[
+                {"role": "user", "content": prompt}
+            ]
+        ) as stream:
+            if self.on_headers:
+                self.on_headers(stream.response.headers)
+            async for text in stream.text_stream:
+                yield text
+
+
+# Local provider for tests and benchmarks: streams canned greentext without
+# touching the network. `delay` is the pause before each chunk in seconds.
+class FakeGenerator(GreentextGenerator):
+    provider = "fake"
+
+    SAMPLE = (
+        ">be me\n"
+        ">{prompt}\n"
+        ">think it's going great\n"
+        ">it is not going great\n"
+        ">everyone saw\n"
+        ">mfw\n"
+    )
+
+    def __init__(self, model="fake", system_prompt=GREENTEXT_SYSTEM_PROMPT, text=None, chunk_chars=4, delay=0.0):
+        super().__init__(model, system_prompt)
+        self.text = text
+        self.chunk_chars = chunk_chars
+        self.delay = delay
+
+    async def stream(self, prompt, temperature, max_tokens):
+        text = self.text if self.text is not None else self.SAMPLE.format(prompt=prompt)
+        text = text[:max_tokens * self.chunk_chars]
+        for i in range(0, len(text), self.chunk_chars):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            else:
+                await asyncio.sleep(0)
+            yield text[i:i + self.chunk_chars]
+
+
+# Replays a recorded or synthetic stream: `deltas` is a list of (delay, text)
+# pairs, where delay is the gap in seconds before that chunk. speed scales the
+# recorded timing (2.0 = twice as fast, 0 = no delays).
+class ReplayGenerator(GreentextGenerator):
+    provider = "replay"
+
+    def __init__(self, deltas, model="replay", system_prompt=GREENTEXT_SYSTEM_PROMPT, speed=1.0):
+        super().__init__(model, system_prompt)
+        self.deltas = deltas
+        self.speed = speed
+
+    @classmethod
+    def from_jsonl(cls, path, **kwargs):
+        deltas = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    deltas.append((record.get("delay", 0.0), record["text"]))
+        return cls(deltas, **kwargs)
+
+    async def stream(self, prompt, temperature, max_tokens):
+        for delay, text in self.deltas[:max_tokens]:
+            await asyncio.sleep(delay / self.speed if self.speed else 0)
+            yield text
+
+
+# Function to build a generator for a provider slug ("openai", "anthropic", "fake")
+def make_generator(provider, api_key=None, model=None, system_prompt=GREENTEXT_SYSTEM_PROMPT):
+    if provider == "openai":
+        return OpenAIGenerator(api_key, model or DEFAULT_MODELS["openai"], system_prompt)
+    if provider == "anthropic":
+        return AnthropicGenerator(api_key, model or DEFAULT_MODELS["anthropic"], system_prompt)
+    if provider == "fake":
+        return FakeGenerator(model or "fake", system_prompt)
+    raise ValueError(f"Unknown provider: {provider}")
+
+
+# Process-wide event loop that all provider streams run on. Streamlit script
+# threads only wait on a queue, so many sessions share one loop and network
+# I/O never happens on a script thread.
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="greentext-engine", daemon=True)
+            thread.start()
+        return _loop
+
+
+# Function to pick the loop a new client will stream on: the running loop
+# (an async caller such as the server), otherwise the shared engine loop that
+# synchronous callers stream on through iter_stream/run_sync
+def _client_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return get_event_loop()
+
+
+# Function to close an evicted client on its own loop once its streams are done
+def _close_later(client, loop):
+    if loop.is_closed():
+        return
+
+    def close():
+        loop.create_task(client.close())
+
+    loop.call_soon_threadsafe(loop.call_later, CLIENT_CLOSE_GRACE, close)
+
+
+client_registry = ClientRegistry()
+
+
+# Function to run a coroutine on the shared loop and wait for its result
+def run_sync(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+
+class _StreamError:
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+# Function to consume an async delta stream from synchronous code. The stream
+# runs on the shared loop; if the caller stops iterating early (including a
+# Streamlit rerun interrupting the script) the upstream stream is cancelled.
+def iter_stream(agen):
+    deltas = queue.Queue()
+
+    async def pump():
+        try:
+            async for delta in agen:
+                deltas.put(delta)
+        except Exception as e:
+            deltas.put(_StreamError(e))
+        finally:
+            deltas.put(_DONE)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+    try:
+        while True:
+            item = deltas.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _StreamError):
+                raise item.error
+            yield item
+    finally:
+        if not future.done():
+            future.cancel()
@@ -0,0 +1,323 @@
+# PNG/WebP/JPEG and PDF exports.
+#
+# Pillow and ReportLab are imported inside the functions that use them, so
+# importing this module (and starting the app) doesn't pay for them until a
+# session actually exports something.
+
+import functools
+import hashlib
+import io
+from xml.sax.saxutils import escape
+
+from greentext_lines import parse_lines
+
+# Image formats: format name -> (Pillow format, mime type, file extension)
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png", "png"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+
+# Default compression per format: zlib level for PNG, quality for lossy formats
+DEFAULT_COMPRESSION = {
+    "png": 6,
+    "webp": 80,
+    "jpeg": 85,
+}
+
+BACKGROUND = (240, 224, 214)  # #f0e0d6
+HEADER_COLOR = (17, 119, 67)  # #117743
+GREENTEXT_COLOR = (120, 153, 34)  # #789922
+MARGIN = 10
+LINE_HEIGHT = 20
+TEXT_TOP = 40
+MIN_IMAGE_WIDTH = 200
+SEPARATOR_COLOR = (217, 191, 183)  # #d9bfb7
+
+
+# Function to load the image fonts once per process
+@functools.lru_cache(maxsize=None)
+def load_fonts():
+    font = _first_truetype(("Courier", "cour.ttf", "DejaVuSansMono.ttf"), 14)
+    header_font = _first_truetype(("Arial", "arial.ttf", "DejaVuSans.ttf"), 12)
+    return font, header_font
+
+
+def _first_truetype(names, size):
+    from PIL import ImageFont
+
+    for name in names:
+        try:
+            return ImageFont.truetype(name, size)
+        except IOError:
+            continue
+    return ImageFont.load_default()
+
+
+def _text_width(font, text):
+    if hasattr(font, "getlength"):
+        return int(font.getlength(text)) + 1
+    return font.getsize(text)[0]
+
+
+# Normalized lines of a post, shared with the post view (parsed once per post)
+def _post_lines(greentext):
+    return [line.text for line in parse_lines(greentext)]
+
+
+# Function to measure the pixel size of one rendered post
+def _post_size(lines, post_info, font, header_font):
+    content_width = max([_text_width(header_font, post_info)] + [_text_width(font, line) for line in lines])
+    width = max(MIN_IMAGE_WIDTH, content_width + 2 * MARGIN)
+    height = TEXT_TOP + LINE_HEIGHT * len(lines) + MARGIN
+    return width, height
+
+
+# Function to draw one post with its top-left corner at (x, y)
+def _draw_post(draw, x, y, lines, post_info, font, header_font):
+    # Draw header (post info)
+    draw.text((x + MARGIN, y + MARGIN), post_info, fill=HEADER_COLOR, font=header_font)
+
+    # Draw each line of greentext
+    y_position = y + TEXT_TOP
+    for line in lines:
+        draw.text((x + MARGIN, y_position), line, fill=GREENTEXT_COLOR, font=font)
+        y_position += LINE_HEIGHT
+
+
+def _save_image(image, output, image_format, compression):
+    if compression is None:
+        compression = DEFAULT_COMPRESSION[image_format]
+    if image_format == "png":
+        save_options = {"compress_level": compression}
+    else:
+        save_options = {"quality": compression}
+    image.save(output, format=IMAGE_FORMATS[image_format][0], **save_options)
+
+
+# Function to draw and encode one post; callers that rerender the same post
+# should go through export_bytes() with an ExportCache
+def _render_image(greentext, post_info, image_format, compression):
+    from PIL import Image, ImageDraw
+
+    font, header_font = load_fonts()
+    lines = _post_lines(greentext)
+
+    # Size the canvas to the text instead of a fixed width
+    image = Image.new('RGB', _post_size(lines, post_info, font, header_font), BACKGROUND)
+    _draw_post(ImageDraw.Draw(image), 0, 0, lines, post_info, font, header_font)
+
+    img_byte_array = io.BytesIO()
+    _save_image(image, img_byte_array, image_format, compression)
+    return img_byte_array.getvalue()
+
+
+# Function to convert greentext to image. image_format is one of IMAGE_FORMATS;
+# compression is the PNG zlib level (0-9) or the WebP/JPEG quality (1-100).
+def convert_to_image(greentext, post_info, image_format="png", compression=None):
+    if compression is None:
+        compression = DEFAULT_COMPRESSION[image_format]
+    return io.BytesIO(_render_image(greentext, post_info, image_format, compression))
+
+
+# Function to render one post to bytes in an export format ("pdf" or an
+# IMAGE_FORMATS key). Module-level so export worker processes can run it.
+def render_export(greentext, post_info, export_format):
+    if export_format == "pdf":
+        return convert_to_pdf(greentext, post_info).getvalue()
+    return _render_image(greentext, post_info, export_format, DEFAULT_COMPRESSION[export_format])
+
+
+# Function to build the ExportCache key of a post in an export format
+def export_key(greentext, post_info, export_format):
+    return (hashlib.sha256(f"{post_info}\n{greentext}".encode()).hexdigest(), export_format)
+
+
+# Function to render one post to bytes in this process. With `cache` (a
+# greentext_cache.ExportCache) the bytes are shared by everyone exporting the
+# same post and format.
+def export_bytes(greentext, post_info, export_format, cache=None):
+    if cache is None:
+        return render_export(greentext, post_info, export_format)
+    return cache.get_or_build(export_key(greentext, post_info, export_format),
+                              lambda: render_export(greentext, post_info, export_format))
+
+
+# Function to render a thread of posts onto one canvas. entries is a list of
+# (greentext, post_info) pairs laid out in `columns` columns (1 = one long
+# image). Only the final canvas is allocated; posts are drawn straight onto it.
+# output is a path or binary file object; a BytesIO is returned if omitted.
+def convert_thread_to_image(entries, output=None, image_format="png", compression=None, columns=1):
+    from PIL import Image, ImageDraw
+
+    font, header_font = load_fonts()
+    posts = []
+    for greentext, post_info in entries:
+        lines = _post_lines(greentext)
+        posts.append((lines, post_info, _post_size(lines, post_info, font, header_font)))
+    if not posts:
+        raise ValueError("No posts to export")
+
+    column_width = max(size[0] for _, _, size in posts)
+    rows = [posts[i:i + columns] for i in range(0, len(posts), columns)]
+    row_heights = [max(size[1] for _, _, size in row) for row in rows]
+    width = column_width * min(columns, len(posts)) + (min(columns, len(posts)) - 1)
+    height = sum(row_heights) + len(rows) - 1
+    image = Image.new('RGB', (width, height), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+
+    y = 0
+    for row, row_height in zip(rows, row_heights):
+        for column, (lines, post_info, _) in enumerate(row):
+            x = column * (column_width + 1)
+            _draw_post(draw, x, y, lines, post_info, font, header_font)
+            if column:
+                draw.line([(x - 1, y), (x - 1, y + row_height)], fill=SEPARATOR_COLOR)
+        y += row_height
+        if y < height:
+            draw.line([(0, y), (width, y)], fill=SEPARATOR_COLOR)
+            y += 1
+
+    buffer = output if output is not None else io.BytesIO()
+    _save_image(image, buffer, image_format, compression)
+    if output is None:
+        buffer.seek(0)
+    return buffer
+
+
+# PDF layout, matching the Platypus styles below: a 1 inch margin, a bold
+# 10pt header, a 10pt gap, then 12pt Courier lines at 14pt leading + 2pt spacing
+PDF_PAGESIZE = (612.0, 792.0)  # US letter, as reportlab.lib.pagesizes.letter
+PDF_MARGIN = 72
+PDF_HEADER_FONT = ("Helvetica-Bold", 10, 12)
+PDF_TEXT_FONT = ("Courier", 12, 16)
+PDF_HEADER_GAP = 10
+PDF_POST_GAP = 24
+PDF_HEADER_COLOR = '#117743'
+PDF_GREENTEXT_COLOR = '#789922'
+
+
+@functools.lru_cache(maxsize=None)
+def _pdf_color(hex_color):
+    from reportlab.lib import colors
+
+    return colors.HexColor(hex_color)
+
+
+# Draws lines straight onto a ReportLab canvas, starting a new page whenever
+# the next line would cross the bottom margin. Text goes through drawString,
+# so model output is never parsed as markup.
+class PdfWriter:
+    def __init__(self, output, pagesize=PDF_PAGESIZE):
+        from reportlab.lib.utils import simpleSplit
+        from reportlab.pdfgen import canvas
+
+        self._split = simpleSplit
+        self.canvas = canvas.Canvas(output, pagesize=pagesize)
+        self.width, self.height = pagesize
+        self.max_width = self.width - 2 * PDF_MARGIN
+        self.y = self.height - PDF_MARGIN
+        self._font = None
+
+    def new_page(self):
+        self.canvas.showPage()
+        self.y = self.height - PDF_MARGIN
+        self._font = None
+
+    def space(self, height):
+        self.y -= height
+
+    def line(self, text, font, color):
+        name, size, leading = font
+        for part in self._split(text, name, size, self.max_width) or [""]:
+            if self.y - leading < PDF_MARGIN:
+                self.new_page()
+            if self._font != (font, color):
+                self.canvas.setFont(name, size)
+                self.canvas.setFillColor(_pdf_color(color))
+                self._font = (font, color)
+            self.y -= leading
+            self.canvas.drawString(PDF_MARGIN, self.y, part)
+
+    def post(self, greentext, post_info):
+        self.line(post_info, PDF_HEADER_FONT, PDF_HEADER_COLOR)
+        self.space(PDF_HEADER_GAP)
+        for line in _post_lines(greentext):
+            self.line(line, PDF_TEXT_FONT, PDF_GREENTEXT_COLOR)
+
+    def save(self):
+        self.canvas.save()
+
+
+# Function to convert greentext to PDF
+def convert_to_pdf(greentext, post_info):
+    buffer = io.BytesIO()
+    writer = PdfWriter(buffer)
+    writer.post(greentext, post_info)
+    writer.save()
+    buffer.seek(0)
+    return buffer
+
+
+# Function to export a thread of (greentext, post_info) entries as one PDF.
+# Posts are drawn in a single canvas pass and flow across pages; entries can
+# be any iterable, so large batches stream straight into `output` (a path or
+# binary file object; a BytesIO is returned if omitted).
+def convert_thread_to_pdf(entries, output=None):
+    buffer = output if output is not None else io.BytesIO()
+    writer = PdfWriter(buffer)
+    for index, (greentext, post_info) in enumerate(entries):
+        if index:
+            writer.space(PDF_POST_GAP)
+        writer.post(greentext, post_info)
+    writer.save()
+    if output is None:
+        buffer.seek(0)
+    return buffer
+
+
+# Paragraph styles for the Platypus path, built once per process
+@functools.lru_cache(maxsize=None)
+def _platypus_styles():
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
+    styles = getSampleStyleSheet()
+    header_style = ParagraphStyle(
+        'Header',
+        parent=styles['Normal'],
+        textColor=_pdf_color(PDF_HEADER_COLOR),
+        fontSize=10,
+        fontName='Helvetica-Bold'
+    )
+    greentext_style = ParagraphStyle(
+        'Greentext',
+        parent=styles['Normal'],
+        textColor=_pdf_color(PDF_GREENTEXT_COLOR),
+        fontSize=12,
+        fontName='Courier',
+        spaceAfter=2,
+        leading=14  # Reduced line spacing
+    )
+    return header_style, greentext_style
+
+
+# Function to convert greentext to PDF with a full Platypus layout. Slower than
+# convert_to_pdf; kept as the reference path for the PDF benchmark.
+def convert_to_pdf_platypus(greentext, post_info):
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=PDF_PAGESIZE)
+    header_style, greentext_style = _platypus_styles()
+
+    # Create the content, escaping model output so it isn't parsed as markup
+    content = []
+    content.append(Paragraph(escape(post_info), header_style))
+    content.append(Spacer(1, PDF_HEADER_GAP))
+
+    for line in _post_lines(greentext):
+        content.append(Paragraph(escape(line), greentext_style))
+
+    doc.build(content)
+    buffer.seek(0)
+    return buffer
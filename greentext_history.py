@@ -0,0 +1,130 @@
+# Persistent history of finished generations.
+#
+# Every generation is a row in a local SQLite file (WAL mode, so the app and
+# server processes can share it) with its prompt, output, provider, model,
+# parameters, timings and post details. Prompts and outputs are indexed with
+# FTS5 when the SQLite build has it, falling back to LIKE otherwise. Listing
+# and search are paginated by id (keyset), newest first, so a page costs the
+# same however deep it is; list rows carry a short preview and the full
+# output is only read by get().
+#
+# Each row records its owner: the greentext_cache.tenant_fingerprint() of the
+# API key that paid for it. Reads take the list of owners a caller may see, so
+# one session never lists or opens another's prompts; owners=None reads every
+# row and is only for an explicitly shared history. Rows written before
+# owners were recorded have none and only show up in a shared history.
+
+import sqlite3
+import threading
+import time
+
+PREVIEW_CHARS = 160
+
+_COLUMNS = (
+    "prompt", "output", "provider", "model", "temperature", "max_tokens",
+    "ttft", "seconds", "post_time", "post_id", "owner",
+)
+
+
+# Function to turn free text into an FTS5 query: every word must match,
+# as a prefix, and FTS syntax characters in the input are treated literally
+def fts_query(text):
+    terms = ['"' + term.replace('"', '""') + '"*' for term in text.split()]
+    return " ".join(terms)
+
+
+# Function to build the SQL condition restricting rows to `owners` (None = all)
+def _owner_condition(owners):
+    if owners is None:
+        return "", []
+    owners = list(owners)
+    if not owners:
+        return "0", []
+    return f"owner IN ({', '.join('?' * len(owners))})", owners
+
+
+class HistoryStore:
+    def __init__(self, path="greentext_history.db"):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY, created REAL NOT NULL, prompt TEXT NOT NULL, output TEXT NOT NULL, "
+            "provider TEXT, model TEXT, temperature REAL, max_tokens INTEGER, "
+            "ttft REAL, seconds REAL, post_time TEXT, post_id TEXT, owner TEXT)"
+        )
+        if "owner" not in [row["name"] for row in self._db.execute("PRAGMA table_info(history)")]:
+            self._db.execute("ALTER TABLE history ADD COLUMN owner TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS history_owner ON history (owner, id)")
+        try:
+            self._db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS history_fts "
+                "USING fts5(prompt, output, content='history', content_rowid='id')"
+            )
+            self._db.execute(
+                "CREATE TRIGGER IF NOT EXISTS history_insert AFTER INSERT ON history BEGIN "
+                "INSERT INTO history_fts (rowid, prompt, output) VALUES (new.id, new.prompt, new.output); END"
+            )
+            self._db.execute(
+                "CREATE TRIGGER IF NOT EXISTS history_delete AFTER DELETE ON history BEGIN "
+                "INSERT INTO history_fts (history_fts, rowid, prompt, output) "
+                "VALUES ('delete', old.id, old.prompt, old.output); END"
+            )
+            self.fts = True
+        except sqlite3.OperationalError:  # SQLite built without FTS5
+            self.fts = False
+
+    # Function to record a finished generation; returns its id
+    def add(self, prompt, output, provider=None, model=None, temperature=None, max_tokens=None,
+            ttft=None, seconds=None, post_time=None, post_id=None, owner=None):
+        values = (prompt, output, provider, model, temperature, max_tokens, ttft, seconds, post_time, post_id, owner)
+        with self._lock:
+            cursor = self._db.execute(
+                f"INSERT INTO history (created, {', '.join(_COLUMNS)}) VALUES (?, {', '.join('?' * len(_COLUMNS))})",
+                (time.time(), *values)
+            )
+            return cursor.lastrowid
+
+    # Function to read one full entry (including the output), or None if it
+    # doesn't exist or belongs to none of `owners`
+    def get(self, entry_id, owners=None):
+        condition, params = _owner_condition(owners)
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT * FROM history WHERE id = ?{' AND ' + condition if condition else ''}", (entry_id, *params)
+            ).fetchone()
+        return dict(row) if row else None
+
+    # Function to list entries newest first, optionally matching `query`.
+    # Pass the last id of the previous page as `before_id` for the next one.
+    def search(self, query="", limit=10, before_id=None, owners=None):
+        condition, params = _owner_condition(owners)
+        conditions = [condition] if condition else []
+        if query.strip():
+            if self.fts:
+                conditions.append("id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+                params.append(fts_query(query))
+            else:
+                for term in query.split():
+                    conditions.append("(prompt LIKE ? OR output LIKE ?)")
+                    params.extend([f"%{term}%"] * 2)
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, created, prompt, substr(output, 1, ?) AS preview, provider, model "
+                f"FROM history {where} ORDER BY id DESC LIMIT ?",
+                (PREVIEW_CHARS, *params, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete(self, entry_id, owners=None):
+        condition, params = _owner_condition(owners)
+        with self._lock:
+            return self._db.execute(
+                f"DELETE FROM history WHERE id = ?{' AND ' + condition if condition else ''}", (entry_id, *params)
+            ).rowcount > 0
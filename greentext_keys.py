@@ -0,0 +1,209 @@
+# Saved API key storage.
+#
+# Keys are encrypted at rest with Fernet. The secret comes from
+# GREENTEXT_KEYSTORE_SECRET, or is generated once into .greentext_secret
+# (mode 0600). Stores keep a parsed copy in memory and only re-read the
+# backing file when it changes (mtime/size/inode for JSON, SQLite's
+# data_version for the database backend). JSON writes take an exclusive
+# file lock and replace the file atomically, so concurrent sessions can't
+# lose updates or leave a torn file behind. Entries saved by older versions
+# with a plaintext "key" are still readable and get encrypted on the next write.
+
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+PROVIDERS = ("openai", "anthropic")
+SECRET_FILE = ".greentext_secret"
+
+
+# Function to build the short fingerprint shown next to a saved key
+def key_fingerprint(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()[:10]
+
+
+# Function to load (or create once) the Fernet secret used to encrypt keys
+def load_cipher(secret_path=SECRET_FILE):
+    from cryptography.fernet import Fernet
+
+    secret = os.environ.get("GREENTEXT_KEYSTORE_SECRET")
+    if secret:
+        return Fernet(secret.encode())
+    try:
+        fd = os.open(secret_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(secret_path, "rb") as f:
+            return Fernet(f.read().strip())
+    secret = Fernet.generate_key()
+    with os.fdopen(fd, "wb") as f:
+        f.write(secret)
+    return Fernet(secret)
+
+
+def _empty():
+    return {provider: {} for provider in PROVIDERS}
+
+
+# Shared caching and encryption; backends provide _current_version, _read,
+# _save_entry and _delete_entry. load() returns a cached structure shared by
+# every caller, so treat it as read-only. The cipher (and cryptography) is only
+# loaded once a key is actually decrypted or saved.
+class KeyStore:
+    def __init__(self, cipher=None):
+        self._cipher = cipher
+        self._lock = threading.Lock()
+        self._cache = None
+        self._version = None
+
+    @property
+    def cipher(self):
+        if self._cipher is None:
+            self._cipher = load_cipher()
+        return self._cipher
+
+    def load(self):
+        with self._lock:
+            version = self._current_version()
+            if self._cache is None or version != self._version:
+                self._cache = self._read()
+                self._version = version
+            return self._cache
+
+    def names(self, provider):
+        return list(self.load().get(provider, {}))
+
+    def get_key(self, provider, key_name):
+        entry = self.load()[provider][key_name]
+        if "secret" in entry:
+            return self.cipher.decrypt(entry["secret"].encode()).decode()
+        return entry["key"]
+
+    def save(self, provider, key_name, api_key):
+        entry = {
+            "hash": key_fingerprint(api_key),
+            "secret": self.cipher.encrypt(api_key.encode()).decode(),
+        }
+        with self._lock:
+            self._save_entry(provider, key_name, entry)
+            self._cache = None
+
+    def delete(self, provider, key_name):
+        with self._lock:
+            deleted = self._delete_entry(provider, key_name)
+            self._cache = None
+        return deleted
+
+    def _encrypt_legacy(self, data):
+        for entries in data.values():
+            for entry in entries.values():
+                if "key" in entry:
+                    entry["secret"] = self.cipher.encrypt(entry.pop("key").encode()).decode()
+        return data
+
+
+# saved_keys.json backend
+class JsonKeyStore(KeyStore):
+    def __init__(self, path="saved_keys.json", cipher=None):
+        super().__init__(cipher)
+        self.path = path
+
+    def _current_version(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return _empty()
+        with open(self.path, "r") as f:
+            data = json.load(f)
+        for provider in PROVIDERS:
+            data.setdefault(provider, {})
+        return data
+
+    # Exclusive lock on a sidecar file around each read-modify-write
+    @contextlib.contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, data):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".saved_keys.", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+
+    def _save_entry(self, provider, key_name, entry):
+        with self._file_lock():
+            data = self._encrypt_legacy(self._read())
+            data[provider][key_name] = entry
+            self._write(data)
+
+    def _delete_entry(self, provider, key_name):
+        with self._file_lock():
+            data = self._read()
+            if key_name not in data[provider]:
+                return False
+            del data[provider][key_name]
+            self._write(self._encrypt_legacy(data))
+            return True
+
+
+# SQLite backend, for deployments where several processes share the keys
+class SqliteKeyStore(KeyStore):
+    def __init__(self, path, cipher=None):
+        super().__init__(cipher)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS saved_keys ("
+            "provider TEXT NOT NULL, name TEXT NOT NULL, hash TEXT NOT NULL, secret TEXT NOT NULL, "
+            "PRIMARY KEY (provider, name))"
+        )
+
+    def _current_version(self):
+        # data_version changes whenever another connection commits
+        return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _read(self):
+        data = _empty()
+        for provider, name, key_hash, secret in self._db.execute("SELECT provider, name, hash, secret FROM saved_keys"):
+            data.setdefault(provider, {})[name] = {"hash": key_hash, "secret": secret}
+        return data
+
+    def _save_entry(self, provider, key_name, entry):
+        self._db.execute(
+            "INSERT OR REPLACE INTO saved_keys (provider, name, hash, secret) VALUES (?, ?, ?, ?)",
+            (provider, key_name, entry["hash"], entry["secret"])
+        )
+
+    def _delete_entry(self, provider, key_name):
+        cursor = self._db.execute("DELETE FROM saved_keys WHERE provider = ? AND name = ?", (provider, key_name))
+        return cursor.rowcount > 0
@@ -0,0 +1,101 @@
+# Greentext line normalization, shared by the live view, the redisplay and the
+# image/PDF exporters.
+#
+# A response is split on newlines; blank lines are dropped, surrounding
+# whitespace (including the \r of CRLF output) is trimmed and every line is
+# given a leading '>'. Each line becomes a GreentextLine record holding the
+# normalized text (for the exporters) and its escaped HTML (for the post
+# view), so escaping happens once per line. LineParser does this
+# incrementally as deltas arrive, touching each character a constant number
+# of times. Finished posts are remembered in a small process-wide LRU so
+# reruns and exports of a post reuse the records from when it was streamed.
+
+import html
+import threading
+from collections import OrderedDict, namedtuple
+
+GreentextLine = namedtuple("GreentextLine", ["text", "html"])
+
+# Number of finished posts whose line records are kept
+PARSED_POSTS = 256
+
+# Normalized, lowercased prefixes of a closing reaction line ("mfw" = my face
+# when, "tfw" = that feel when); used by the best-of-N scorer and the
+# stop-after-reaction rule
+REACTION_PREFIXES = (">mfw", ">tfw")
+
+
+# Function to normalize one raw line into a GreentextLine (None if blank)
+def normalize_line(line):
+    line = line.strip()
+    if not line:
+        return None
+    if not line.startswith('>'):
+        line = '>' + line
+    return GreentextLine(line, f"<div class='greentext-line'>{html.escape(line, quote=False)}</div>")
+
+
+# Incremental parser: feed() takes stream deltas and returns the records of
+# the lines they completed; partial() is the still-open last line.
+class LineParser:
+    def __init__(self):
+        self.lines = []
+        self._pending = []
+
+    def feed(self, delta):
+        if '\n' not in delta:
+            if delta:
+                self._pending.append(delta)
+            return []
+        head, *complete, tail = delta.split('\n')
+        self._pending.append(head)
+        raw_lines = ["".join(self._pending), *complete]
+        self._pending = [tail] if tail else []
+        new_lines = [record for record in map(normalize_line, raw_lines) if record is not None]
+        self.lines.extend(new_lines)
+        return new_lines
+
+    def partial(self):
+        return normalize_line("".join(self._pending)) if self._pending else None
+
+    # Finish the last line and return the full list of records
+    def close(self):
+        last = self.partial()
+        self._pending = []
+        if last is not None:
+            self.lines.append(last)
+        return self.lines
+
+
+_parsed = OrderedDict()
+_parsed_lock = threading.Lock()
+
+
+# Function to record the parsed lines of a finished post
+def remember_lines(text, lines):
+    lines = tuple(lines)
+    with _parsed_lock:
+        _parsed[text] = lines
+        _parsed.move_to_end(text)
+        while len(_parsed) > PARSED_POSTS:
+            _parsed.popitem(last=False)
+    return lines
+
+
+# Function to forget every remembered post (benchmarks time cold parses)
+def clear_parsed_lines():
+    with _parsed_lock:
+        _parsed.clear()
+
+
+# Function to get the line records of a finished post, parsing it only if it
+# hasn't been seen recently
+def parse_lines(text):
+    with _parsed_lock:
+        lines = _parsed.get(text)
+        if lines is not None:
+            _parsed.move_to_end(text)
+            return lines
+    parser = LineParser()
+    parser.feed(text)
+    return remember_lines(text, parser.close())
@@ -0,0 +1,104 @@
+# Memory diagnostics for long-lived app processes.
+#
+# With GREENTEXT_MEMORY_DEBUG=1 every script run measures its session state
+# (deep size of all values) and records it here, so the debug panel can show
+# the footprint of every live session, their total and the process RSS. With
+# GREENTEXT_TRACEMALLOC=1 tracemalloc is also started to list the top
+# allocation sites. Both cost time on every run; leave them off in production.
+
+import os
+import sys
+import threading
+import time
+
+MEMORY_DEBUG = os.environ.get("GREENTEXT_MEMORY_DEBUG") == "1"
+TRACEMALLOC = os.environ.get("GREENTEXT_TRACEMALLOC") == "1"
+
+
+# Function to estimate the memory held by an object and everything it
+# references through containers (dicts, lists, tuples, sets), counting
+# shared objects once
+def deep_sizeof(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+# Function to read this process's resident set size in bytes (None if unknown)
+def process_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak rather than current RSS; kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# Last measured session-state size per session id
+class SessionFootprints:
+    def __init__(self):
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def record(self, session_id, nbytes, keys):
+        with self._lock:
+            self._sizes[session_id] = {"bytes": nbytes, "keys": keys, "updated": time.time()}
+
+    # Drop sessions for which is_active(session_id) is False
+    def prune(self, is_active):
+        with self._lock:
+            for session_id in [sid for sid in self._sizes if not is_active(sid)]:
+                del self._sizes[session_id]
+
+    # Rows of {session, bytes, keys, idle_seconds}, largest first
+    def rows(self):
+        now = time.time()
+        with self._lock:
+            items = list(self._sizes.items())
+        return sorted(
+            (
+                {"session": session_id[:8], "bytes": entry["bytes"], "keys": entry["keys"],
+                 "idle_seconds": round(now - entry["updated"])}
+                for session_id, entry in items
+            ),
+            key=lambda row: row["bytes"],
+            reverse=True,
+        )
+
+    def total(self):
+        with self._lock:
+            return sum(entry["bytes"] for entry in self._sizes.values())
+
+
+session_footprints = SessionFootprints()
+
+
+# Function to list the biggest allocation sites by line, if tracemalloc runs
+def top_allocations(limit=10):
+    import tracemalloc
+
+    if not tracemalloc.is_tracing():
+        return []
+    stats = tracemalloc.take_snapshot().statistics("lineno")[:limit]
+    return [{"site": str(stat.traceback[0]), "bytes": stat.size, "blocks": stat.count} for stat in stats]
+
+
+if TRACEMALLOC:
+    import tracemalloc
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
@@ -0,0 +1,165 @@
+# In-process metrics for generation and export.
+#
+# Every timing is recorded as a `greentext_stage_seconds` sample labelled with
+# the stage plus provider/model where known. Recent samples are kept per
+# series for p50/p95, and running count/sum for Prometheus. Metrics can be
+# scraped from serve_prometheus() (GREENTEXT_METRICS_PORT in the app) and/or
+# appended to a JSONL log (GREENTEXT_METRICS_LOG).
+
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from greentext_engine import GreentextGenerator
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    def __init__(self, window=1024, log_path=None):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=self.window))
+        self._sums = defaultdict(float)
+        self._counts = defaultdict(int)
+        self._counters = defaultdict(float)
+        self._log = open(log_path, "a", buffering=1) if log_path else None
+
+    def observe(self, metric, value, **labels):
+        key = (metric, tuple(sorted((name, str(v)) for name, v in labels.items())))
+        with self._lock:
+            self._samples[key].append(value)
+            self._sums[key] += value
+            self._counts[key] += 1
+            if self._log:
+                self._log.write(json.dumps({"ts": time.time(), "metric": metric, "value": value, **labels}) + "\n")
+
+    def inc(self, metric, value=1, **labels):
+        key = (metric, tuple(sorted((name, str(v)) for name, v in labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    # Time a block as one sample of greentext_stage_seconds{stage=...}
+    @contextlib.contextmanager
+    def span(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("greentext_stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+    # Rows of {metric, labels, count, p50, p95} over the recent window
+    def summary(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._samples.items()}
+        rows = []
+        for (metric, labels), values in sorted(series.items()):
+            rows.append({
+                "metric": metric,
+                **dict(labels),
+                "count": len(values),
+                "p50": _percentile(values, 0.5),
+                "p95": _percentile(values, 0.95),
+            })
+        return rows
+
+    def render_prometheus(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._samples.items()}
+            sums = dict(self._sums)
+            counts = dict(self._counts)
+            counters = dict(self._counters)
+        lines = []
+        typed = set()
+        for (metric, labels), values in sorted(series.items()):
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} summary")
+                typed.add(metric)
+            for quantile in (0.5, 0.95):
+                quantile_labels = labels + (("quantile", str(quantile)),)
+                lines.append(f"{metric}{_format_labels(quantile_labels)} {_percentile(values, quantile)}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {sums[(metric, labels)]}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {counts[(metric, labels)]}")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(log_path=os.environ.get("GREENTEXT_METRICS_LOG"))
+
+
+# Function to serve metrics in Prometheus text format on a background thread
+def serve_prometheus(port, host="0.0.0.0", registry=metrics):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="greentext-metrics", daemon=True).start()
+    return server
+
+
+# Generator wrapper that records provider timings: time to first token, total
+# stream time, chunks/sec (stream chunks stand in for tokens) and errors.
+# Streams the caller stops early (closed or cancelled) are recorded as well.
+class MeteredGenerator(GreentextGenerator):
+    def __init__(self, inner, registry=metrics):
+        super().__init__(inner.model, inner.system_prompt)
+        self.provider = inner.provider
+        self.inner = inner
+        self.registry = registry
+
+    async def stream(self, prompt, temperature, max_tokens):
+        labels = {"provider": self.provider, "model": self.model}
+        start = time.perf_counter()
+        deltas = self.inner.stream(prompt, temperature, max_tokens)
+        chunks = 0
+        failed = False
+        try:
+            async for delta in deltas:
+                if chunks == 0:
+                    self.registry.observe("greentext_stage_seconds", time.perf_counter() - start, stage="ttft", **labels)
+                chunks += 1
+                yield delta
+        except Exception:
+            failed = True
+            self.registry.inc("greentext_errors_total", **labels)
+            raise
+        finally:
+            if not failed:
+                self._record_stream(labels, start, chunks)
+            await deltas.aclose()
+
+    def _record_stream(self, labels, start, chunks):
+        elapsed = time.perf_counter() - start
+        self.registry.observe("greentext_stage_seconds", elapsed, stage="stream", **labels)
+        self.registry.inc("greentext_chunks_total", chunks, **labels)
+        if elapsed > 0:
+            self.registry.observe("greentext_chunks_per_second", chunks / elapsed, **labels)
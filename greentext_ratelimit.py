@@ -0,0 +1,250 @@
+# Per-API-key request/token budgets and retries.
+#
+# Each (provider, key hash) gets a KeyScheduler with two token buckets, one for
+# requests and one for tokens, both refilling per minute. A request reserves
+# one request plus its estimated tokens (prompt chars / 4 + max_tokens) and
+# sleeps until the reservation is covered, so callers sharing a key queue up
+# and get spaced out instead of hitting 429s together. Limits start from
+# DEFAULT_LIMITS and are adjusted from the provider's rate-limit headers on
+# every response; a 429 with Retry-After pauses the whole key. A limit of 0
+# means unlimited (the fake provider has no budget).
+
+import asyncio
+import datetime
+import hashlib
+import random
+import re
+import threading
+import time
+
+from greentext_engine import GreentextGenerator
+from greentext_metrics import metrics
+
+# Starting (requests per minute, tokens per minute) budget per provider;
+# providers not listed here are unlimited
+DEFAULT_LIMITS = {
+    "openai": (500, 30000),
+    "anthropic": (50, 40000),
+}
+
+# Backoff bounds for retries, in seconds
+BASE_RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+# HTTP statuses worth retrying: timeouts, rate limits, overload and 5xx
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+# Function to decide whether a provider error is transient
+def is_retryable(error):
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError") or isinstance(error, (asyncio.TimeoutError, ConnectionError))
+
+
+# Function to read a Retry-After header (in seconds) from a provider error
+def retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+# Function to parse a reset header: OpenAI durations ("6m0s", "20ms") or
+# Anthropic RFC 3339 timestamps. Returns seconds from now, or None.
+def parse_reset(value):
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+    try:
+        reset_at = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, (reset_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+# Token bucket that allows a negative balance: each reservation is granted
+# immediately and told how long to wait before it is covered.
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+    # Give back part of a reservation that turned out not to be needed
+    def refund(self, amount):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    # Trust the provider's view of the window when it is tighter than ours
+    def observe(self, limit, remaining, reset, now):
+        self._refill(now)
+        if not self.rate:
+            return
+        if limit:
+            self.capacity = float(limit)
+            self.rate = limit / 60.0
+        if remaining is not None:
+            self.tokens = min(self.tokens, float(remaining))
+            if reset and remaining <= 0:
+                self.tokens = min(self.tokens, -reset * self.rate)
+
+
+def _header_int(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class KeyScheduler:
+    def __init__(self, provider, requests_per_minute=None, tokens_per_minute=None):
+        default_rpm, default_tpm = DEFAULT_LIMITS.get(provider, (0, 0))
+        self.provider = provider
+        self.requests = TokenBucket(default_rpm if requests_per_minute is None else requests_per_minute)
+        self.tokens = TokenBucket(default_tpm if tokens_per_minute is None else tokens_per_minute)
+        self.paused_until = 0.0
+        self.waiting = 0
+        self._lock = threading.Lock()
+
+    # Wait until this key's budget covers one request of `estimated_tokens`
+    async def acquire(self, estimated_tokens):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(
+                self.requests.reserve(1, now),
+                self.tokens.reserve(estimated_tokens, now),
+                self.paused_until - now,
+            )
+            self.waiting += 1
+            metrics.observe("greentext_ratelimit_queue_depth", self.waiting, provider=self.provider)
+        try:
+            if wait > 0:
+                await asyncio.sleep(wait)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        metrics.observe("greentext_stage_seconds", wait, stage="ratelimit_wait", provider=self.provider)
+        return wait
+
+    def refund(self, tokens):
+        with self._lock:
+            self.tokens.refund(tokens)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # Function to pick the wait before retry number `attempt` (0-based):
+    # Retry-After when the provider sent one, otherwise jittered exponential
+    # backoff. A 429 pauses every request on this key, not just this one.
+    def backoff(self, error, attempt, base_delay=BASE_RETRY_DELAY, max_delay=MAX_RETRY_DELAY):
+        self.update_from_headers(getattr(getattr(error, "response", None), "headers", None))
+        delay = retry_after(error)
+        if delay is None:
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if getattr(error, "status_code", None) == 429:
+            self.pause(delay)
+        metrics.inc("greentext_retries_total", provider=self.provider)
+        return delay
+
+    # Adjust the buckets from OpenAI (x-ratelimit-*) or Anthropic
+    # (anthropic-ratelimit-*) response headers
+    def update_from_headers(self, headers):
+        if not headers:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for kind, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+                for prefix, template in (("x-ratelimit", "{prefix}-{field}-{kind}"), ("anthropic-ratelimit", "{prefix}-{kind}-{field}")):
+                    limit = _header_int(headers, template.format(prefix=prefix, field="limit", kind=kind))
+                    remaining = _header_int(headers, template.format(prefix=prefix, field="remaining", kind=kind))
+                    if limit is None and remaining is None:
+                        continue
+                    reset = parse_reset(headers.get(template.format(prefix=prefix, field="reset", kind=kind)))
+                    bucket.observe(limit, remaining, reset, now)
+
+
+# Process-wide schedulers keyed by (provider, sha256 of the key), so every
+# session sharing a saved key shares its budget
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def scheduler_for(provider, api_key, requests_per_minute=None, tokens_per_minute=None):
+    key = (provider, hashlib.sha256((api_key or "").encode()).hexdigest())
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            scheduler = _schedulers[key] = KeyScheduler(provider, requests_per_minute, tokens_per_minute)
+        return scheduler
+
+
+# Function to route a generator's rate-limit headers (from the provider
+# generator at the bottom of any wrapper stack) into a scheduler
+def watch_headers(generator, scheduler):
+    while getattr(generator, "inner", None) is not None:
+        generator = generator.inner
+    generator.on_headers = scheduler.update_from_headers
+
+
+# Function to estimate the tokens a request can use: the prompt at roughly
+# four characters per token plus the whole completion budget
+def estimate_tokens(system_prompt, prompt, max_tokens):
+    return (len(system_prompt) + len(prompt)) // 4 + max_tokens
+
+
+# Generator wrapper that waits for the key's budget before each attempt and
+# retries transient failures (429, 5xx, connection errors). Only failures
+# before the first delta are retried, so a caller never sees a response
+# restart midway. Unused completion tokens are refunded to the budget however
+# the attempt ends, including when the caller stops the stream early.
+class RateLimitedGenerator(GreentextGenerator):
+    def __init__(self, inner, scheduler, max_retries=4):
+        super().__init__(inner.model, inner.system_prompt)
+        self.provider = inner.provider
+        self.inner = inner
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+        watch_headers(inner, scheduler)
+
+    async def stream(self, prompt, temperature, max_tokens):
+        for attempt in range(self.max_retries + 1):
+            await self.scheduler.acquire(estimate_tokens(self.system_prompt, prompt, max_tokens))
+            deltas = self.inner.stream(prompt, temperature, max_tokens)
+            chars = 0
+            try:
+                async for delta in deltas:
+                    chars += len(delta)
+                    yield delta
+            except Exception as e:
+                if chars or attempt == self.max_retries or not is_retryable(e):
+                    raise
+                delay = self.scheduler.backoff(e, attempt)
+            else:
+                return
+            finally:
+                self.scheduler.refund(max(0, max_tokens - chars // 4))
+                await deltas.aclose()
+            await asyncio.sleep(delay)
@@ -0,0 +1,102 @@
+import datetime
+import random
+import time
+
+from greentext_lines import LineParser, normalize_line, parse_lines, remember_lines
+
+# Post markup shared by the live stream view and the redisplay block
+POST_TEMPLATE = """
+<div class="greentext-container">
+    <div class="post-header">
+        Anonymous {current_time} <span class="post-number">{post_id}</span>
+    </div>
+    <div class="post-content">
+        {body}
+    </div>
+</div>
+"""
+
+# Function to generate the timestamp and post number shown in a post header
+def new_post_details():
+    current_time = datetime.datetime.now().strftime('%m/%d/%y(%a)%H:%M:%S')
+    post_id = f"No.{random.randint(100000000, 999999999)}"
+    return current_time, post_id
+
+# Function to format a single line of greentext (returns None for blank lines)
+def format_line(line):
+    record = normalize_line(line)
+    return record.html if record is not None else None
+
+# Function to format a whole response (parsed once, then reused)
+def format_lines(text):
+    return [line.html for line in parse_lines(text)]
+
+# Function to wrap formatted lines in the 4chan post structure
+def build_post_html(current_time, post_id, body):
+    return POST_TEMPLATE.format(current_time=current_time, post_id=post_id, body=body)
+
+# Function to render a finished response as post HTML
+def render_post_html(text, current_time, post_id):
+    return build_post_html(current_time, post_id, "\n".join(format_lines(text)))
+
+
+# Incremental renderer for streamed responses.
+#
+# Completed lines are parsed and escaped exactly once (greentext_lines) and
+# appended to a cached HTML body; only the trailing partial line is
+# re-formatted on each flush. close() hands the parsed lines to the shared
+# cache, so redisplays and exports of the post don't parse it again. Flushes
+# to the container happen when a line completes or when flush_interval
+# seconds have passed since the last one, so a 1000-token response sends a
+# few dozen updates instead of one per token.
+class StreamingRenderer:
+    def __init__(self, container, current_time, post_id, flush_interval=0.1, clock=time.monotonic):
+        self.container = container
+        self.current_time = current_time
+        self.post_id = post_id
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self._chunks = []
+        self._parser = LineParser()
+        self._body = ""
+        self._last_flush = None
+        self._dirty = False
+        self.flushes = 0
+
+    @property
+    def text(self):
+        return "".join(self._chunks)
+
+    def feed(self, delta):
+        if not delta:
+            return
+        self._chunks.append(delta)
+        self._dirty = True
+
+        completed = '\n' in delta
+        new_lines = self._parser.feed(delta)
+        if new_lines:
+            formatted = "\n".join(line.html for line in new_lines)
+            self._body = f"{self._body}\n{formatted}" if self._body else formatted
+
+        now = self._clock()
+        if completed or self._last_flush is None or now - self._last_flush >= self.flush_interval:
+            self.flush(now)
+
+    def flush(self, now=None):
+        body = self._body
+        partial = self._parser.partial()
+        if partial is not None:
+            body = f"{body}\n{partial.html}" if body else partial.html
+        self.container.markdown(build_post_html(self.current_time, self.post_id, body), unsafe_allow_html=True)
+        self._last_flush = self._clock() if now is None else now
+        self._dirty = False
+        self.flushes += 1
+
+    # Flush whatever is still pending and return the full response text
+    def close(self):
+        if self._dirty:
+            self.flush()
+        text = self.text
+        remember_lines(text, self._parser.close())
+        return text
@@ -0,0 +1,171 @@
+# Per-request provider routing with failover.
+#
+# RoutingGenerator holds one candidate generator per provider (each behind its
+# key's rate-limit scheduler) and ranks them on every request from live stats:
+# a moving average of time to first token and of the error rate. Candidates
+# that meet the TTFT SLO and error budget are "healthy"; the cheapest healthy
+# one (by configured per-token prices) goes first, then the rest by expected
+# latency. A candidate with no stats yet counts as healthy so it gets tried.
+#
+# If a candidate fails, or sends nothing within FIRST_TOKEN_TIMEOUT, before its
+# first token, the request moves on to the next one; once text has been sent
+# the request stays on that provider. A small fraction of requests go to the
+# runner-up so a provider that recovers is noticed.
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+from greentext_engine import DEFAULT_MODELS, GreentextGenerator, make_generator
+from greentext_metrics import MeteredGenerator, metrics
+from greentext_ratelimit import RateLimitedGenerator, scheduler_for
+
+# USD per million (input, output) tokens. GREENTEXT_PRICES can override or
+# add models as JSON, e.g. {"gpt-4o": [2.5, 10]}.
+PRICES = {
+    "gpt-4.5-preview": (75.0, 150.0),
+    "claude-3-5-sonnet-20240620": (3.0, 15.0),
+}
+PRICES.update({model: tuple(price) for model, price in json.loads(os.environ.get("GREENTEXT_PRICES", "{}")).items()})
+
+# Routing targets: time to first token (seconds) and error rate a provider must
+# stay under to be preferred on price
+TTFT_SLO = float(os.environ.get("GREENTEXT_TTFT_SLO", "2.0"))
+MAX_ERROR_RATE = float(os.environ.get("GREENTEXT_MAX_ERROR_RATE", "0.2"))
+# Give up on a candidate that hasn't sent its first token after this many seconds
+FIRST_TOKEN_TIMEOUT = float(os.environ.get("GREENTEXT_FIRST_TOKEN_TIMEOUT", "6.0"))
+EXPLORE_RATE = 0.05
+
+
+# Function to estimate the cost of one request in USD, assuming the whole
+# completion budget is used and roughly four characters per token
+def estimate_cost(model, system_prompt, prompt, max_tokens):
+    input_price, output_price = PRICES.get(model, (0.0, 0.0))
+    return ((len(system_prompt) + len(prompt)) / 4 * input_price + max_tokens * output_price) / 1e6
+
+
+# Moving averages of TTFT and error rate per (provider, model), shared by
+# every RoutingGenerator in the process
+class RouteStats:
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, provider, model):
+        return self._stats.setdefault((provider, model), {"ttft": None, "error_rate": 0.0, "requests": 0})
+
+    def record_success(self, provider, model, ttft):
+        with self._lock:
+            entry = self._entry(provider, model)
+            entry["ttft"] = ttft if entry["ttft"] is None else entry["ttft"] + self.alpha * (ttft - entry["ttft"])
+            entry["error_rate"] *= 1 - self.alpha
+            entry["requests"] += 1
+
+    def record_failure(self, provider, model):
+        with self._lock:
+            entry = self._entry(provider, model)
+            entry["error_rate"] += self.alpha * (1 - entry["error_rate"])
+            entry["requests"] += 1
+
+    def get(self, provider, model):
+        with self._lock:
+            return dict(self._entry(provider, model))
+
+    # Rows of {provider, model, ttft, error_rate, requests} for display
+    def summary(self):
+        with self._lock:
+            return [{"provider": provider, "model": model, **entry} for (provider, model), entry in sorted(self._stats.items())]
+
+
+route_stats = RouteStats()
+
+
+class RoutingGenerator(GreentextGenerator):
+    provider = "auto"
+
+    def __init__(self, candidates, stats=route_stats, ttft_slo=TTFT_SLO, max_error_rate=MAX_ERROR_RATE,
+                 first_token_timeout=FIRST_TOKEN_TIMEOUT, explore_rate=EXPLORE_RATE):
+        super().__init__("+".join(candidate.model for candidate in candidates), candidates[0].system_prompt)
+        self.candidates = candidates
+        self.stats = stats
+        self.ttft_slo = ttft_slo
+        self.max_error_rate = max_error_rate
+        self.first_token_timeout = first_token_timeout
+        self.explore_rate = explore_rate
+        # The candidate that served the last request
+        self.chosen = None
+
+    # Function to order candidates for one request: healthy ones cheapest
+    # first, then the rest by expected latency (TTFT inflated by error rate)
+    def rank(self, prompt, max_tokens):
+        def sort_key(candidate):
+            entry = self.stats.get(candidate.provider, candidate.model)
+            if entry["ttft"] is None:
+                healthy, ttft = entry["error_rate"] <= self.max_error_rate, 0.0
+            else:
+                healthy, ttft = entry["ttft"] <= self.ttft_slo and entry["error_rate"] <= self.max_error_rate, entry["ttft"]
+            if healthy:
+                return (0, estimate_cost(candidate.model, self.system_prompt, prompt, max_tokens), ttft)
+            return (1, ttft / max(0.01, 1 - entry["error_rate"]), 0.0)
+
+        ranked = sorted(self.candidates, key=sort_key)
+        if len(ranked) > 1 and random.random() < self.explore_rate:
+            ranked[0], ranked[1] = ranked[1], ranked[0]
+        return ranked
+
+    async def stream(self, prompt, temperature, max_tokens):
+        ranked = self.rank(prompt, max_tokens)
+        for position, candidate in enumerate(ranked):
+            last = position == len(ranked) - 1
+            deltas = candidate.stream(prompt, temperature, max_tokens).__aiter__()
+            start = time.perf_counter()
+            try:
+                first = await asyncio.wait_for(deltas.__anext__(), None if last else self.first_token_timeout)
+            except StopAsyncIteration:
+                first = None
+            except Exception:
+                self.stats.record_failure(candidate.provider, candidate.model)
+                await deltas.aclose()
+                if last:
+                    raise
+                metrics.inc("greentext_failovers_total", provider=candidate.provider, model=candidate.model)
+                continue
+
+            self.stats.record_success(candidate.provider, candidate.model, time.perf_counter() - start)
+            self.chosen = candidate
+            metrics.inc("greentext_routed_total", provider=candidate.provider, model=candidate.model)
+            if first is None:
+                return
+            try:
+                yield first
+                async for delta in deltas:
+                    yield delta
+            except Exception:
+                self.stats.record_failure(candidate.provider, candidate.model)
+                raise
+            finally:
+                await deltas.aclose()
+            return
+
+
+# Function to build a router over every provider that has a key in
+# `api_keys` ({provider: key}). With a single candidate there is nothing to
+# fail over to, so it keeps its own retries instead.
+def make_routing_generator(api_keys, models=None):
+    models = models or {}
+    keyed = [(provider, api_key) for provider, api_key in api_keys.items() if api_key]
+    if not keyed:
+        raise ValueError("Routing needs at least one API key")
+    candidates = [
+        RateLimitedGenerator(
+            MeteredGenerator(make_generator(provider, api_key, models.get(provider) or DEFAULT_MODELS.get(provider))),
+            scheduler_for(provider, api_key),
+            max_retries=0 if len(keyed) > 1 else 4
+        )
+        for provider, api_key in keyed
+    ]
+    return RoutingGenerator(candidates)
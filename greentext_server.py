@@ -0,0 +1,224 @@
+# Headless greentext service (ASGI).
+#
+# Run with several worker processes:
+#   uvicorn greentext_server:app --host 0.0.0.0 --port 8000 --workers 4
+#   (or: python greentext_server.py --workers 4)
+#
+# Endpoints:
+#   POST /v1/generate       {"prompt", "provider", "model", "temperature", "max_tokens"}
+#                           temperature is 0-2 and max_tokens 1 to
+#                           GREENTEXT_MAX_TOKENS_LIMIT (default 4096).
+#                           Streams Server-Sent Events: "delta" events with {"text"},
+#                           then one "done" event with the full text (or "error").
+#                           Add ?stream=false for a single JSON response.
+#                           Requests are queued per API key to fit its rate limits
+#                           and transient provider errors are retried.
+#   POST /v1/export/{fmt}   {"greentext", "post_info"} -> txt, png, webp, jpeg or pdf bytes
+#                           Rendered by a pool of export worker processes
+#                           (see greentext_workers); 503 when its queue is
+#                           full, 504 when a job runs past its timeout.
+#   GET  /metrics           Prometheus text format
+#   GET  /healthz
+#
+# The provider API key is taken from the X-Provider-Key header, falling back
+# to OPENAI_API_KEY / ANTHROPIC_API_KEY in the server environment. Cached and
+# coalesced responses are only shared between requests using the same key. With
+# "provider": "auto" each request is routed between every provider that has a
+# key in the environment (see greentext_router).
+
+import argparse
+import contextlib
+import json
+import os
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from greentext_cache import CachedGenerator, ExportCache, GenerationCache, tenant_fingerprint
+from greentext_coalesce import CoalescingGenerator
+from greentext_control import StreamController
+from greentext_engine import DEFAULT_MODELS, make_generator
+from greentext_export import IMAGE_FORMATS
+from greentext_metrics import MeteredGenerator, metrics
+from greentext_ratelimit import RateLimitedGenerator, scheduler_for
+from greentext_render import new_post_details
+from greentext_router import make_routing_generator
+from greentext_workers import ExportBusy, ExportPool
+
+generation_cache = GenerationCache(db_path=os.environ.get("GREENTEXT_CACHE_DB"))
+export_cache = ExportCache(int(float(os.environ.get("GREENTEXT_EXPORT_CACHE_MB", "64")) * 1024 * 1024))
+# Started with the app (each uvicorn worker gets its own pool)
+export_pool = None
+# Accepted generation settings
+MAX_TEMPERATURE = 2.0
+MAX_TOKENS_LIMIT = int(os.environ.get("GREENTEXT_MAX_TOKENS_LIMIT", "4096"))
+
+
+def _error(status, message):
+    return JSONResponse({"error": message}, status_code=status)
+
+
+# Function to check that the optional JSON `fields` of `body` are strings;
+# returns an error message for the first one that isn't
+def _check_strings(body, *fields):
+    for field in fields:
+        if body.get(field) is not None and not isinstance(body[field], str):
+            return f"'{field}' must be a string"
+    return None
+
+
+# Function to check that `value` is a JSON number (an integer if `integer`)
+# between `low` and `high`
+def _in_range(value, low, high, integer=False):
+    if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)):
+        return False
+    return low <= value <= high
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def generate(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return _error(400, "Request body must be JSON")
+    if not isinstance(body, dict):
+        return _error(400, "Request body must be a JSON object")
+    invalid = _check_strings(body, "prompt", "provider", "model")
+    if invalid:
+        return _error(400, invalid)
+    prompt = body.get("prompt")
+    provider = body.get("provider") or "openai"
+    if not prompt or not prompt.strip():
+        return _error(400, "Missing 'prompt'")
+    temperature = body.get("temperature", 1.0)
+    max_tokens = body.get("max_tokens", 300)
+    if not _in_range(temperature, 0, MAX_TEMPERATURE):
+        return _error(400, f"'temperature' must be a number from 0 to {MAX_TEMPERATURE:g}")
+    if not _in_range(max_tokens, 1, MAX_TOKENS_LIMIT, integer=True):
+        return _error(400, f"'max_tokens' must be an integer from 1 to {MAX_TOKENS_LIMIT}")
+    if provider not in DEFAULT_MODELS and provider not in ("fake", "auto"):
+        return _error(400, f"Unknown provider: {provider}")
+    if provider == "auto":
+        api_keys = {name: os.environ.get(f"{name.upper()}_API_KEY") for name in DEFAULT_MODELS}
+        api_key = next((key for key in api_keys.values() if key), None)
+    else:
+        api_key = request.headers.get("x-provider-key") or os.environ.get(f"{provider.upper()}_API_KEY")
+    if provider != "fake" and not api_key:
+        return _error(401, f"No API key for {provider}")
+
+    if provider == "auto":
+        upstream = make_routing_generator(api_keys)
+        tenant = tenant_fingerprint(*api_keys.values())
+    else:
+        tenant = tenant_fingerprint(api_key)
+        upstream = RateLimitedGenerator(
+            MeteredGenerator(make_generator(provider, api_key, body.get("model"))),
+            scheduler_for(provider, api_key)
+        )
+    generator = CachedGenerator(CoalescingGenerator(StreamController(upstream), tenant), generation_cache, tenant)
+
+    if request.query_params.get("stream") == "false":
+        try:
+            chunks = [delta async for delta in generator.stream(prompt, temperature, max_tokens)]
+        except Exception as e:
+            # Pass provider rate limiting through once our own retries are exhausted
+            return _error(429 if getattr(e, "status_code", None) == 429 else 502, f"Error while generating text: {e}")
+        return JSONResponse({"text": "".join(chunks), "provider": generator.provider, "model": generator.model})
+
+    async def events():
+        chunks = []
+        try:
+            async for delta in generator.stream(prompt, temperature, max_tokens):
+                chunks.append(delta)
+                yield _sse("delta", {"text": delta})
+        except Exception as e:
+            yield _sse("error", {"error": f"Error while generating text: {e}"})
+            return
+        yield _sse("done", {"text": "".join(chunks), "provider": generator.provider, "model": generator.model})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+async def export(request):
+    export_format = request.path_params["fmt"]
+    try:
+        body = await request.json()
+    except ValueError:
+        return _error(400, "Request body must be JSON")
+    if not isinstance(body, dict):
+        return _error(400, "Request body must be a JSON object")
+    invalid = _check_strings(body, "greentext", "post_info")
+    if invalid:
+        return _error(400, invalid)
+    greentext = body.get("greentext")
+    if not greentext:
+        return _error(400, "Missing 'greentext'")
+    post_info = body.get("post_info")
+    if not post_info:
+        current_time, post_id = new_post_details()
+        post_info = f"Anonymous {current_time} {post_id}"
+
+    if export_format == "txt":
+        return PlainTextResponse(greentext)
+    # Rendering is CPU-bound; it runs in the export pool and a threadpool
+    # thread waits for it, keeping the event loop free
+    if export_format == "pdf":
+        media_type = "application/pdf"
+    elif export_format in IMAGE_FORMATS:
+        media_type = IMAGE_FORMATS[export_format][1]
+    else:
+        return _error(404, f"Unknown export format: {export_format}")
+    try:
+        with metrics.span("export", format=export_format):
+            data = await run_in_threadpool(export_pool.export, greentext, post_info, export_format, export_cache)
+    except ExportBusy as e:
+        return JSONResponse({"error": f"Export queue is full: {e}"}, status_code=503, headers={"Retry-After": "1"})
+    except TimeoutError as e:
+        return _error(504, str(e))
+    return Response(data, media_type=media_type)
+
+
+async def prometheus(request):
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+async def healthz(request):
+    return JSONResponse({"status": "ok"})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global export_pool
+    export_pool = ExportPool()
+    try:
+        yield
+    finally:
+        export_pool.shutdown()
+
+
+app = Starlette(lifespan=lifespan, routes=[
+    Route("/v1/generate", generate, methods=["POST"]),
+    Route("/v1/export/{fmt}", export, methods=["POST"]),
+    Route("/metrics", prometheus),
+    Route("/healthz", healthz),
+])
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the greentext HTTP service")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    uvicorn.run("greentext_server:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
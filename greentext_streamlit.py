@@ -1,87 +1,27 @@
 import streamlit as st
-from openai import OpenAI
-import anthropic
-import json
-import datetime
-import random
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import os
-import hashlib
-import io
-from PIL import Image, ImageDraw, ImageFont
 import base64
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
-
-# Function to convert greentext to image
-def convert_to_image(greentext, post_info):
-    # Create a new image with a beige background (#f0e0d6)
-    width, height = 600, max(500, 100 + 20 * len(greentext.split('\n')))
-    image = Image.new('RGB', (width, height), (240, 224, 214))  # #f0e0d6
-    draw = ImageDraw.Draw(image)
-    
-    # Try to load a monospace font
-    try:
-        font = ImageFont.truetype("Courier", 14)
-        header_font = ImageFont.truetype("Arial", 12)
-    except IOError:
-        font = ImageFont.load_default()
-        header_font = ImageFont.load_default()
-    
-    # Draw header (post info)
-    draw.text((10, 10), post_info, fill=(17, 119, 67), font=header_font)  # #117743
-    
-    # Draw each line of greentext
-    y_position = 40
-    for line in greentext.split('\n'):
-        if line.strip():
-            draw.text((10, y_position), line, fill=(120, 153, 34), font=font)  # #789922
-            y_position += 20
-    
-    # Convert to bytes
-    img_byte_array = io.BytesIO()
-    image.save(img_byte_array, format='PNG')
-    img_byte_array.seek(0)
-    return img_byte_array
-
-# Function to convert greentext to PDF
-def convert_to_pdf(greentext, post_info):
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
-    
-    # Create custom styles
-    header_style = ParagraphStyle(
-        'Header',
-        parent=styles['Normal'],
-        textColor=colors.HexColor('#117743'),
-        fontSize=10,
-        fontName='Helvetica-Bold'
-    )
-    
-    greentext_style = ParagraphStyle(
-        'Greentext',
-        parent=styles['Normal'],
-        textColor=colors.HexColor('#789922'),
-        fontSize=12,
-        fontName='Courier',
-        spaceAfter=2,
-        leading=14  # Reduced line spacing
-    )
-    
-    # Create the content
-    content = []
-    content.append(Paragraph(post_info, header_style))
-    content.append(Spacer(1, 10))
-    
-    for line in greentext.split('\n'):
-        if line.strip():
-            content.append(Paragraph(line, greentext_style))
-    
-    doc.build(content)
-    buffer.seek(0)
-    return buffer
+import queue
+import asyncio
+import functools
+import json
+import time
+from greentext_render import StreamingRenderer, new_post_details, render_post_html
+from greentext_engine import DEFAULT_MODELS, make_generator, iter_stream, get_event_loop
+from greentext_batch import BatchStore, read_prompts, run_batch, thread_entries
+from greentext_bestof import best_of_n, score_greentext
+from greentext_export import IMAGE_FORMATS, convert_thread_to_image, convert_thread_to_pdf
+from greentext_cache import CachedGenerator, ExportCache, GenerationCache, tenant_fingerprint
+from greentext_coalesce import CoalescingGenerator
+from greentext_control import StreamController
+from greentext_history import HistoryStore
+from greentext_keys import JsonKeyStore, SqliteKeyStore
+from greentext_memory import MEMORY_DEBUG, deep_sizeof, process_rss, session_footprints, top_allocations
+from greentext_metrics import MeteredGenerator, metrics, serve_prometheus
+from greentext_ratelimit import RateLimitedGenerator, scheduler_for
+from greentext_router import make_routing_generator, route_stats
+from greentext_workers import ExportPool
 
 # Near the top of the script, initialize session state for key management
 if 'key_saved' not in st.session_state:
@@ -89,34 +29,34 @@ if 'key_saved' not in st.session_state:
     st.session_state.key_name = ""
     st.session_state.key_provider = ""
 
+# Process-wide saved key store (encrypted at rest, cached in memory).
+# Set GREENTEXT_KEYSTORE_DB to keep keys in SQLite instead of saved_keys.json.
+@st.cache_resource
+def get_key_store():
+    if os.environ.get("GREENTEXT_KEYSTORE_DB"):
+        return SqliteKeyStore(os.environ["GREENTEXT_KEYSTORE_DB"])
+    return JsonKeyStore("saved_keys.json")
+
 # Function to load saved API keys
 def load_saved_keys():
     try:
-        if os.path.exists("saved_keys.json"):
-            with open("saved_keys.json", "r") as f:
-                return json.load(f)
-        return {"openai": {}, "anthropic": {}}
+        return get_key_store().load()
     except Exception as e:
         st.error(f"Error loading saved keys: {str(e)}")
         return {"openai": {}, "anthropic": {}}
 
+# Function to read a saved API key
+def get_saved_key(provider, key_name):
+    try:
+        return get_key_store().get_key(provider.lower(), key_name)
+    except Exception as e:
+        st.error(f"Error reading saved key: {str(e)}")
+        return ""
+
 # Function to save API keys
 def save_key(provider, key_name, api_key):
-    saved_keys = load_saved_keys()
-    
-    # Create a unique hash of the API key as the value
-    # This adds a layer of security compared to storing plain text
-    key_hash = hashlib.sha256(api_key.encode()).hexdigest()[:10]
-    
-    # Save the key with its name and hash
-    saved_keys[provider.lower()][key_name] = {
-        "hash": key_hash,
-        "key": api_key  # In a production app, consider encrypting this
-    }
-    
     try:
-        with open("saved_keys.json", "w") as f:
-            json.dump(saved_keys, f)
+        get_key_store().save(provider.lower(), key_name, api_key)
         return True
     except Exception as e:
         st.error(f"Error saving key: {str(e)}")
@@ -124,17 +64,116 @@ def save_key(provider, key_name, api_key):
 
 # Function to delete a saved key
 def delete_key(provider, key_name):
-    saved_keys = load_saved_keys()
-    if key_name in saved_keys[provider.lower()]:
-        del saved_keys[provider.lower()][key_name]
-        try:
-            with open("saved_keys.json", "w") as f:
-                json.dump(saved_keys, f)
-            return True
-        except Exception as e:
-            st.error(f"Error deleting key: {str(e)}")
+    try:
+        return get_key_store().delete(provider.lower(), key_name)
+    except Exception as e:
+        st.error(f"Error deleting key: {str(e)}")
     return False
 
+# Function to pick a saved key or enter a new one for a provider in the sidebar
+def key_input(provider_slug, label, name_placeholder):
+    api_key = ""
+    saved_provider_keys = list(saved_keys[provider_slug].keys())
+    
+    # Key selection or new key input
+    key_option = "Enter a new key"
+    if saved_provider_keys:
+        key_options = ["Select a saved key", "Enter a new key"]
+        key_choice = st.radio(f"{label} API Key Options", key_options, key=f"{provider_slug}_key_choice")
+        
+        if key_choice == "Select a saved key":
+            selected_key_name = st.selectbox("Choose a saved key", saved_provider_keys, key=f"{provider_slug}_saved_key")
+            api_key = get_saved_key(provider_slug, selected_key_name)
+            st.success(f"Using saved key: {selected_key_name}")
+            
+            # Option to delete the key
+            if st.button("Delete this saved key", key=f"{provider_slug}_delete_key"):
+                if delete_key(provider_slug, selected_key_name):
+                    st.success(f"Deleted key: {selected_key_name}")
+                    st.rerun()
+            key_option = key_choice
+    
+    # Input for new key
+    if key_option == "Enter a new key":
+        api_key = st.text_input(f"{label} API Key", type="password", help=f"Enter your {label} API key")
+        
+        # Option to save the key
+        if api_key:
+            save_key_checkbox = st.checkbox("Save this key for future use", key=f"{provider_slug}_save_key")
+            if save_key_checkbox:
+                key_name = st.text_input("Name for this key", placeholder=name_placeholder, key=f"{provider_slug}_key_name")
+                if key_name and st.button("Save Key", key=f"{provider_slug}_save_button"):
+                    if save_key(provider_slug, key_name, api_key):
+                        st.session_state.key_saved = True
+                        st.session_state.key_name = key_name
+                        st.session_state.key_provider = label
+    
+    st.caption(f"Your {label} API key is not stored on any server and is only used for API calls")
+    return api_key
+
+# Download format labels for image exports -> greentext_export format names
+IMAGE_DOWNLOADS = {
+    "Image (.png)": "png",
+    "Image (.webp)": "webp",
+    "Image (.jpg)": "jpeg",
+}
+
+# Shared response cache for deterministic (temperature 0) generations.
+# Set GREENTEXT_CACHE_DB to a file path to keep entries across restarts.
+@st.cache_resource
+def get_generation_cache():
+    return GenerationCache(db_path=os.environ.get("GREENTEXT_CACHE_DB"))
+
+# Persistent, searchable history of generations (GREENTEXT_HISTORY_DB sets the file)
+@st.cache_resource
+def get_history_store():
+    return HistoryStore(os.environ.get("GREENTEXT_HISTORY_DB", "greentext_history.db"))
+
+HISTORY_PAGE_SIZE = 10
+# Each session only sees generations made with its own API keys unless the
+# history is explicitly shared between everyone using this app
+SHARED_HISTORY = os.environ.get("GREENTEXT_SHARED_HISTORY") == "1"
+
+# Shared, size-bounded cache of export bytes (GREENTEXT_EXPORT_CACHE_MB, default 64)
+@st.cache_resource
+def get_export_cache():
+    return ExportCache(int(float(os.environ.get("GREENTEXT_EXPORT_CACHE_MB", "64")) * 1024 * 1024))
+
+# Finished batch results shared by all sessions; a session keeps only its
+# batch id (GREENTEXT_BATCH_STORE_MB bounds the total size)
+@st.cache_resource
+def get_batch_store():
+    return BatchStore(int(float(os.environ.get("GREENTEXT_BATCH_STORE_MB", "32")) * 1024 * 1024))
+
+# Function to read a batch's records from the store; empty once it was dropped
+def batch_records_for(batch_id):
+    return get_batch_store().get(batch_id) or []
+
+# Process pool that renders images and PDFs off the script thread
+# (GREENTEXT_EXPORT_WORKERS, GREENTEXT_EXPORT_QUEUE, GREENTEXT_EXPORT_TIMEOUT)
+@st.cache_resource
+def get_export_pool():
+    return ExportPool()
+
+# Function to build the compact session record for the post on screen
+def generation_record(text, post_time, post_id, history_id=None, from_history=False):
+    return {
+        "text": text,
+        "post_time": post_time,
+        "post_id": post_id,
+        "history_id": history_id,
+        "from_history": from_history,
+    }
+
+# Prometheus endpoint for this process, started once if GREENTEXT_METRICS_PORT is set
+@st.cache_resource
+def start_metrics_server():
+    if os.environ.get("GREENTEXT_METRICS_PORT"):
+        return serve_prometheus(int(os.environ["GREENTEXT_METRICS_PORT"]))
+    return None
+
+start_metrics_server()
+
 # Set page config
 st.set_page_config(
     page_title="Greentext Generator",
@@ -235,107 +274,94 @@ with st.sidebar:
     # AI provider selection
     provider = st.radio(
         "AI Provider",
-        ["OpenAI", "Anthropic (Claude)"],
+        ["OpenAI", "Anthropic (Claude)", "Auto (route per request)"],
         index=0,
-        help="Select which AI provider to use"
+        help="Select which AI provider to use, or let each request be routed by live latency, errors and price"
     )
     
-    # API Keys based on provider
-    if provider == "OpenAI":
-        # Get saved OpenAI keys
-        saved_openai_keys = list(saved_keys["openai"].keys())
-        
-        # Key selection or new key input
-        key_option = "Enter a new key"
-        if saved_openai_keys:
-            key_options = ["Select a saved key", "Enter a new key"]
-            key_choice = st.radio("API Key Options", key_options)
-            
-            if key_choice == "Select a saved key":
-                selected_key_name = st.selectbox("Choose a saved key", saved_openai_keys)
-                api_key = saved_keys["openai"][selected_key_name]["key"]
-                st.success(f"Using saved key: {selected_key_name}")
-                
-                # Option to delete the key
-                if st.button("Delete this saved key"):
-                    if delete_key("openai", selected_key_name):
-                        st.success(f"Deleted key: {selected_key_name}")
-                        st.rerun()
-                key_option = key_choice
-        
-        # Input for new key
-        if key_option == "Enter a new key":
-            openai_api_key = st.text_input("OpenAI API Key", type="password", help="Enter your OpenAI API key")
-            api_key = openai_api_key
-            
-            # Option to save the key
-            if openai_api_key:
-                save_key_checkbox = st.checkbox("Save this key for future use")
-                if save_key_checkbox:
-                    key_name = st.text_input("Name for this key", placeholder="e.g., My OpenAI Key")
-                    if key_name and st.button("Save Key"):
-                        if save_key("openai", key_name, openai_api_key):
-                            st.session_state.key_saved = True
-                            st.session_state.key_name = key_name
-                            st.session_state.key_provider = "OpenAI"
-            
-        st.caption("Your OpenAI API key is not stored on any server and is only used for API calls")
-    
+    # API Keys based on provider (both in Auto mode)
+    if provider == "Auto (route per request)":
+        api_keys = {
+            "openai": key_input("openai", "OpenAI", "e.g., My OpenAI Key"),
+            "anthropic": key_input("anthropic", "Anthropic", "e.g., My Claude Key"),
+        }
+        key_hint = "an OpenAI or Anthropic API key"
+    elif provider == "OpenAI":
+        api_keys = {"openai": key_input("openai", "OpenAI", "e.g., My OpenAI Key")}
+        key_hint = f"your {provider} API key"
     else:  # Anthropic
-        # Get saved Anthropic keys
-        saved_anthropic_keys = list(saved_keys["anthropic"].keys())
-        
-        # Key selection or new key input
-        key_option = "Enter a new key"
-        if saved_anthropic_keys:
-            key_options = ["Select a saved key", "Enter a new key"]
-            key_choice = st.radio("API Key Options", key_options)
-            
-            if key_choice == "Select a saved key":
-                selected_key_name = st.selectbox("Choose a saved key", saved_anthropic_keys)
-                api_key = saved_keys["anthropic"][selected_key_name]["key"]
-                st.success(f"Using saved key: {selected_key_name}")
-                
-                # Option to delete the key
-                if st.button("Delete this saved key"):
-                    if delete_key("anthropic", selected_key_name):
-                        st.success(f"Deleted key: {selected_key_name}")
-                        st.rerun()
-                key_option = key_choice
-        
-        # Input for new key
-        if key_option == "Enter a new key":
-            anthropic_api_key = st.text_input("Anthropic API Key", type="password", help="Enter your Anthropic API key")
-            api_key = anthropic_api_key
-            
-            # Option to save the key
-            if anthropic_api_key:
-                save_key_checkbox = st.checkbox("Save this key for future use")
-                if save_key_checkbox:
-                    key_name = st.text_input("Name for this key", placeholder="e.g., My Claude Key")
-                    if key_name and st.button("Save Key"):
-                        if save_key("anthropic", key_name, anthropic_api_key):
-                            st.session_state.key_saved = True
-                            st.session_state.key_name = key_name
-                            st.session_state.key_provider = "Anthropic"
-            
-        st.caption("Your Anthropic API key is not stored on any server and is only used for API calls")
+        api_keys = {"anthropic": key_input("anthropic", "Anthropic", "e.g., My Claude Key")}
+        key_hint = f"your {provider} API key"
+    api_key = next((key for key in api_keys.values() if key), "")
+    # Cached and coalesced responses are only shared between sessions using the same keys
+    tenant = tenant_fingerprint(*api_keys.values())
+    history_owners = None if SHARED_HISTORY else [tenant_fingerprint(key) for key in api_keys.values() if key]
     
     # Common generation settings
     st.subheader("Generation Settings")
     
     # Model selection based on provider
-    if provider == "OpenAI":
-        model = "gpt-4.5-preview"
+    if provider == "Auto (route per request)":
+        provider_slug = "auto"
+        model = "routed"
+        st.info("Each request goes to the cheapest provider meeting the latency target, failing over if it errors before the first token")
+    elif provider == "OpenAI":
+        provider_slug = "openai"
+        model = DEFAULT_MODELS[provider_slug]
         st.info("Using OpenAI GPT-4.5 Preview model")
     else:  # Anthropic
-        model = "claude-3-5-sonnet-20240620"
+        provider_slug = "anthropic"
+        model = DEFAULT_MODELS[provider_slug]
         st.info("Using Claude 3.5 Sonnet model")
     
     temperature = st.slider("Temperature", min_value=0.0, max_value=2.0, value=1.0, step=0.1, 
                            help="Higher values make output more random, lower values more deterministic")
     max_tokens = st.slider("Max Length", min_value=50, max_value=1000, value=300, step=50,
                           help="Maximum length of the generated text")
+    candidates = st.slider("Candidates (best of N)", min_value=1, max_value=4, value=1,
+                           help="Generate several greentexts at once and keep the best formatted one (needs temperature above 0)")
+    
+    # Response cache counters (only temperature 0 requests are cached)
+    cache_stats = get_generation_cache().stats()
+    st.caption(f"Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses (temperature 0 only)")
+    
+    # Per-stage latency panel, shown with ?debug=1 or GREENTEXT_DEBUG=1
+    if st.query_params.get("debug") == "1" or os.environ.get("GREENTEXT_DEBUG") == "1":
+        with st.expander("Performance (debug)"):
+            stage_rows = metrics.summary()
+            if stage_rows:
+                st.dataframe(stage_rows, hide_index=True)
+            else:
+                st.caption("No timings recorded yet")
+            if route_stats.summary():
+                st.caption("Routing (moving averages)")
+                st.dataframe(route_stats.summary(), hide_index=True)
+            
+            # Memory: process RSS, shared caches and (with GREENTEXT_MEMORY_DEBUG=1)
+            # the session-state footprint of every live session
+            rss = process_rss()
+            export_stats = get_export_cache().stats()
+            batch_stats = get_batch_store().stats()
+            st.caption(
+                (f"Process RSS {rss / 2**20:.1f} MiB · " if rss else "")
+                + f"export cache {export_stats['bytes'] / 2**20:.1f} MiB in {export_stats['entries']} entries "
+                + f"({export_stats['evictions']} evicted) · generation cache {cache_stats['memory_entries']} entries"
+                + f" · batch results {batch_stats['bytes'] / 2**20:.1f} MiB in {batch_stats['batches']} batches"
+            )
+            pool_stats = get_export_pool().stats()
+            st.caption(
+                f"Export workers {pool_stats['workers']} · {pool_stats['pending']}/{pool_stats['max_pending']} jobs pending "
+                + f"· {pool_stats['rejected']} rejected · {pool_stats['timeouts']} timed out"
+            )
+            if MEMORY_DEBUG:
+                if st.runtime.exists():
+                    session_footprints.prune(st.runtime.get_instance().is_active_session)
+                session_rows = session_footprints.rows()
+                st.caption(f"{len(session_rows)} sessions holding {session_footprints.total() / 1024:.1f} KiB of session state")
+                st.dataframe(session_rows, hide_index=True)
+                allocation_rows = top_allocations()
+                if allocation_rows:
+                    st.dataframe(allocation_rows, hide_index=True)
 
 # Main area for prompt input
 user_prompt = st.text_area("Enter your greentext prompt:", 
@@ -345,17 +371,16 @@ user_prompt = st.text_area("Enter your greentext prompt:",
 # Generate button
 generate_button = st.button("Generate Greentext", type="primary", use_container_width=True)
 
-# At the beginning of the script after other session state initializations, add:
-if 'full_response' not in st.session_state:
-    st.session_state.full_response = ""
-    st.session_state.current_time = ""
-    st.session_state.random_post_id = ""
-    st.session_state.has_generated = False
+# The session keeps one compact record of the post on screen: its text, post
+# details and history id. Export bytes live in the shared export cache, so an
+# idle session costs little more than its text.
+if 'generation' not in st.session_state:
+    st.session_state.generation = None
 
 # Handle generation
 if generate_button:
     if not api_key:
-        st.error(f"Please enter your {provider} API key in the sidebar")
+        st.error(f"Please enter {key_hint} in the sidebar")
     elif not user_prompt:
         st.warning("Please enter a prompt")
     else:
@@ -365,163 +390,223 @@ if generate_button:
             result_container = st.empty()
             result_container.markdown("<div class='generated-text'></div>", unsafe_allow_html=True)
             success_message = st.empty()
-            download_button_placeholder = st.empty()
             full_response = ""
             
             # Generate post details once at the beginning
-            current_time = datetime.datetime.now().strftime('%m/%d/%y(%a)%H:%M:%S')
-            random_post_id = f"No.{random.randint(100000000, 999999999)}"
-            
-            # System prompt for greentext
-            greentext_system_prompt = (
-                "You are creating authentic 4chan greentext stories. "
-                "Follow these rules exactly:\n"
-                "1. Every line MUST start with '>' (no space after >)\n"
-                "2. First line should typically be '>be me' or similar\n" 
-                "3. Keep lines very short - rarely more than 10-15 words\n"
-                "4. Use 4chan terminology: anon, mfw (my face when), tfw (that feel when), etc.\n"
-                "5. Be edgy, self-deprecating, and include twist endings\n"
-                "6. No paragraph breaks - just line breaks\n"
-                "7. Include at least one reaction line like '>mfw' at the end\n"
-                "8. Keep content edgy, absurd and vulgar - this is 4chan style\n"
-                "DO NOT include anything except the greentext lines. Do not explain or preface."
-            )
+            current_time, random_post_id = new_post_details()
             
-            with st.spinner(f"Generating greentext with {provider}..."):
-                # OpenAI API call
-                if provider == "OpenAI":
-                    client = OpenAI(api_key=api_key)
-                    stream = client.chat.completions.create(
-                        model=model,
-                        messages=[
-                            {"role": "system", "content": greentext_system_prompt},
-                            {"role": "user", "content": user_prompt}
-                        ],
-                        max_tokens=max_tokens,
-                        temperature=temperature,
-                        stream=True
+            stage_labels = {"provider": provider_slug, "model": model}
+            with st.spinner(f"Generating greentext with {provider}..."), metrics.span("generate", **stage_labels):
+                # Stream from the selected provider on the shared engine loop,
+                # queued behind other sessions using the same key
+                if provider_slug == "auto":
+                    router = make_routing_generator(api_keys)
+                    upstream = router
+                else:
+                    router = None
+                    upstream = RateLimitedGenerator(
+                        MeteredGenerator(make_generator(provider_slug, api_key, model)),
+                        scheduler_for(provider_slug, api_key)
                     )
-                    
-                    # Process the OpenAI streaming response
-                    for chunk in stream:
-                        if hasattr(chunk.choices[0].delta, 'content'):
-                            content = chunk.choices[0].delta.content or ""
-                            full_response += content
-                            
-                            # Format each line to have the proper greentext styling
-                            formatted_lines = []
-                            for line in full_response.split('\n'):
-                                if line.strip():
-                                    if line.startswith('>'):
-                                        formatted_lines.append(f"<div class='greentext-line'>{line}</div>")
-                                    else:
-                                        formatted_lines.append(f"<div class='greentext-line'>>{line}</div>")
-                            
-                            formatted_html = "\n".join(formatted_lines)
-                            
-                            # Create a realistic 4chan post structure - using the pre-generated IDs
-                            post_html = f"""
-                            <div class="greentext-container">
-                                <div class="post-header">
-                                    Anonymous {current_time} <span class="post-number">{random_post_id}</span>
-                                </div>
-                                <div class="post-content">
-                                    {formatted_html}
-                                </div>
-                            </div>
-                            """
-
-                            result_container.markdown(post_html, unsafe_allow_html=True)
-                
-                # Anthropic API call
+                started = time.perf_counter()
+                ttft = None
+                if candidates > 1 and temperature > 0:
+                    # Best of N: candidates stream side by side, bypassing the
+                    # cache and coalescing (which would merge identical requests)
+                    generator = StreamController(upstream)
+                    candidate_details = [(current_time, random_post_id)] + [new_post_details() for _ in range(candidates - 1)]
+                    candidate_columns = result_container.container().columns(candidates)
+                    candidate_views = [column.empty() for column in candidate_columns]
+                    candidate_status = [column.empty() for column in candidate_columns]
+                    renderers = [
+                        StreamingRenderer(view, *details) for view, details in zip(candidate_views, candidate_details)
+                    ]
+                    for kind, index, payload in iter_stream(best_of_n(generator, user_prompt, temperature, max_tokens, candidates)):
+                        if kind == "delta":
+                            if ttft is None:
+                                ttft = time.perf_counter() - started
+                            with metrics.span("render", **stage_labels):
+                                renderers[index].feed(payload)
+                        elif kind == "finished":
+                            candidate_status[index].caption(f"Score {payload:.2f}")
+                        elif kind == "error":
+                            candidate_status[index].caption(f"Failed: {payload}")
+                        elif kind == "cancelled":
+                            candidate_status[index].caption("Stopped")
+                        elif kind == "winner":
+                            winner, full_response = index, payload
+                    for renderer in renderers:
+                        renderer.close()
+                    candidate_status[winner].caption(f"Picked (score {score_greentext(full_response):.2f})")
+                    current_time, random_post_id = candidate_details[winner]
                 else:
-                    client = anthropic.Anthropic(api_key=api_key)
-                    
-                    with client.messages.stream(
-                        model=model,
-                        max_tokens=max_tokens,
-                        temperature=temperature,
-                        system=greentext_system_prompt,
-                        messages=[
-                            {"role": "user", "content": user_prompt}
-                        ]
-                    ) as stream:
-                        # Process the Anthropic streaming response
-                        for text in stream.text_stream:
-                            full_response += text
-                            
-                            # Format each line to have the proper greentext styling
-                            formatted_lines = []
-                            for line in full_response.split('\n'):
-                                if line.strip():
-                                    if line.startswith('>'):
-                                        formatted_lines.append(f"<div class='greentext-line'>{line}</div>")
-                                    else:
-                                        formatted_lines.append(f"<div class='greentext-line'>>{line}</div>")
-                            
-                            formatted_html = "\n".join(formatted_lines)
-                            
-                            # Create a realistic 4chan post structure
-                            post_html = f"""
-                            <div class="greentext-container">
-                                <div class="post-header">
-                                    Anonymous {current_time} <span class="post-number">{random_post_id}</span>
-                                </div>
-                                <div class="post-content">
-                                    {formatted_html}
-                                </div>
-                            </div>
-                            """
-
-                            result_container.markdown(post_html, unsafe_allow_html=True)
+                    generator = CachedGenerator(CoalescingGenerator(StreamController(upstream), tenant), get_generation_cache(), tenant)
+                    renderer = StreamingRenderer(result_container, current_time, random_post_id)
+                    for delta in iter_stream(generator.stream(user_prompt, temperature, max_tokens)):
+                        if ttft is None:
+                            ttft = time.perf_counter() - started
+                        with metrics.span("render", **stage_labels):
+                            renderer.feed(delta)
+                    full_response = renderer.close()
+                seconds = time.perf_counter() - started
+            
+            # Keep a permanent copy in the history store, owned by the key that paid for it
+            served_by = router.chosen if router is not None and router.chosen is not None else generator
+            history_id = None
+            try:
+                history_id = get_history_store().add(
+                    user_prompt, full_response, served_by.provider, served_by.model, temperature, max_tokens,
+                    ttft, seconds, current_time, random_post_id,
+                    owner=tenant_fingerprint(api_keys.get(served_by.provider) or api_key)
+                )
+            except Exception as e:
+                st.warning(f"Could not save to history: {str(e)}")
             
             # Store the generation in session state so it persists across reruns
-            st.session_state.full_response = full_response
-            st.session_state.current_time = current_time
-            st.session_state.random_post_id = random_post_id
-            st.session_state.has_generated = True
+            st.session_state.generation = generation_record(full_response, current_time, random_post_id, history_id)
             
             # Show success message after completion
-            success_message.success(f"Greentext generated successfully with {provider}!")
-            
-            # After showing success message, replace the download button with these options
-            if full_response:
-                st.markdown("### Download Options")
-                download_format = st.selectbox(
-                    "Choose download format:",
-                    ["Text (.txt)", "Image (.png)", "PDF (.pdf)"],
-                    index=0
-                )
-                
-                post_info = f"Anonymous {current_time} {random_post_id}"
-                
-                if download_format == "Text (.txt)":
-                    download_button_placeholder.download_button(
-                        label="Download as Text File",
-                        data=full_response,
-                        file_name="greentext.txt",
-                        mime="text/plain"
-                    )
-                elif download_format == "Image (.png)":
-                    img_bytes = convert_to_image(full_response, post_info)
-                    download_button_placeholder.download_button(
-                        label="Download as Image",
-                        data=img_bytes,
-                        file_name="greentext.png",
-                        mime="image/png"
-                    )
-                else:  # PDF
-                    pdf_bytes = convert_to_pdf(full_response, post_info)
-                    download_button_placeholder.download_button(
-                        label="Download as PDF",
-                        data=pdf_bytes,
-                        file_name="greentext.pdf",
-                        mime="application/pdf"
-                    )
+            if router is not None and router.chosen is not None:
+                done = f"Greentext generated successfully with {router.chosen.provider} ({router.chosen.model})!"
+            else:
+                done = f"Greentext generated successfully with {provider}!"
+            if candidates > 1 and temperature > 0:
+                done += f" Picked candidate {winner + 1} of {candidates}."
+            success_message.success(done)
                 
         except Exception as e:
-            st.error(f"Error while generating text: {str(e)}")
+            if getattr(e, "status_code", None) == 429:
+                st.error(f"{provider} is still rate limiting this API key after several retries. Please wait a minute and try again.")
+            else:
+                st.error(f"Error while generating text: {str(e)}")
             
+# Batch mode: generate a greentext for every prompt in an uploaded file
+with st.expander("Batch mode"):
+    prompt_file = st.file_uploader(
+        "Upload prompts (CSV with a 'prompt' column, JSONL, or one prompt per line)",
+        type=["csv", "jsonl", "txt"]
+    )
+    batch_concurrency = st.slider("Concurrent requests", min_value=1, max_value=16, value=4)
+    
+    if prompt_file is not None and st.button("Run batch"):
+        prompt_error = None
+        try:
+            batch_prompts = read_prompts(prompt_file.getvalue().decode("utf-8-sig"), prompt_file.name)
+        except UnicodeDecodeError:
+            prompt_error = "The uploaded file isn't UTF-8 text"
+        except ValueError as e:
+            prompt_error = f"Couldn't read prompts: {str(e)}"
+        if prompt_error:
+            st.error(prompt_error)
+        elif not api_key:
+            st.error(f"Please enter {key_hint} in the sidebar")
+        elif not batch_prompts:
+            st.warning("No prompts found in the uploaded file")
+        else:
+            # The batch runs on the engine loop; results arrive here as each item finishes
+            finished = queue.Queue()
+            if provider_slug == "auto":
+                # Each routed provider already waits on its own key's scheduler
+                batch_upstream = make_routing_generator(api_keys)
+            else:
+                # Batch items wait on the same per-key scheduler as interactive requests
+                batch_upstream = RateLimitedGenerator(
+                    MeteredGenerator(make_generator(provider_slug, api_key, model)),
+                    scheduler_for(provider_slug, api_key)
+                )
+            generator = CachedGenerator(CoalescingGenerator(StreamController(batch_upstream), tenant), get_generation_cache(), tenant)
+            batch_future = asyncio.run_coroutine_threadsafe(
+                run_batch(batch_prompts, generator, None,
+                          concurrency=batch_concurrency, temperature=temperature,
+                          max_tokens=max_tokens, on_result=finished.put),
+                get_event_loop()
+            )
+            progress = st.progress(0.0, text="Generating...")
+            for done in range(1, len(batch_prompts) + 1):
+                finished.get()
+                progress.progress(done / len(batch_prompts), text=f"Generated {done}/{len(batch_prompts)}")
+            batch_records = batch_future.result()
+            failed = sum(1 for record in batch_records if "error" in record)
+            st.session_state.batch_id = get_batch_store().put(batch_records)
+            st.success(f"Batch finished: {len(batch_records) - failed} generated, {failed} failed")
+    
+    batch_id = st.session_state.get("batch_id")
+    if batch_id and get_batch_store().get(batch_id) is None:
+        st.info("These batch results are no longer kept; run the batch again to download them")
+        del st.session_state.batch_id
+    elif batch_id:
+        # Downloads read the shared batch store only when clicked
+        st.download_button(
+            label="Download batch results (.jsonl)",
+            data=lambda: "".join(json.dumps(record) + "\n" for record in batch_records_for(batch_id)),
+            file_name="greentexts.jsonl",
+            mime="application/json"
+        )
+        
+        # Whole-batch thread exports, built in one pass by an export worker when clicked
+        thread_pdf, thread_png = st.columns(2)
+        thread_pdf.download_button(
+            label="Download thread as PDF",
+            data=lambda: get_export_pool().run(convert_thread_to_pdf, list(thread_entries(batch_records_for(batch_id))), format="pdf").getvalue(),
+            file_name="greentext_thread.pdf",
+            mime="application/pdf"
+        )
+        thread_png.download_button(
+            label="Download thread as Image",
+            data=lambda: get_export_pool().run(
+                functools.partial(convert_thread_to_image, columns=2), list(thread_entries(batch_records_for(batch_id))), format="png"
+            ).getvalue(),
+            file_name="greentext_thread.png",
+            mime="image/png"
+        )
+
+# History: past generations made with this session's API keys, searched and
+# paged straight from the history store; only the current page cursor is kept
+# in session state
+with st.expander("History"):
+    history_query = st.text_input("Search history", placeholder="e.g., usb drive", key="history_query")
+    if st.session_state.get("history_searched") != (history_query, history_owners):
+        st.session_state.history_searched = (history_query, history_owners)
+        st.session_state.history_cursors = [None]
+    history_cursors = st.session_state.history_cursors
+    
+    try:
+        history_rows = get_history_store().search(
+            history_query, limit=HISTORY_PAGE_SIZE + 1, before_id=history_cursors[-1], owners=history_owners
+        )
+    except Exception as e:
+        st.error(f"Error reading history: {str(e)}")
+        history_rows = []
+    has_next_page = len(history_rows) > HISTORY_PAGE_SIZE
+    history_rows = history_rows[:HISTORY_PAGE_SIZE]
+    
+    if history_owners == []:
+        st.caption(f"Enter {key_hint} to see the generations made with it")
+    elif not history_rows:
+        st.caption("No matching generations" if history_query else "No generations saved yet")
+    for row in history_rows:
+        entry_info, entry_open = st.columns([5, 1])
+        entry_info.markdown(f"**{row['prompt']}**")
+        entry_info.caption(
+            f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(row['created']))} · {row['provider']} {row['model']} · "
+            + row["preview"].replace("\n", " ")
+        )
+        # Reopen a past generation without calling the API again
+        if entry_open.button("Open", key=f"history_open_{row['id']}"):
+            entry = get_history_store().get(row["id"], owners=history_owners)
+            if entry is not None:
+                st.session_state.generation = generation_record(
+                    entry["output"], entry["post_time"] or "", entry["post_id"] or "", entry["id"], from_history=True
+                )
+    
+    previous_page, next_page = st.columns(2)
+    if len(history_cursors) > 1 and previous_page.button("Newer", key="history_newer"):
+        history_cursors.pop()
+        st.rerun()
+    if has_next_page and next_page.button("Older", key="history_older"):
+        history_cursors.append(history_rows[-1]["id"])
+        st.rerun()
+
 # Footer
 st.markdown("---")
 st.caption("Note: This application uses AI APIs to generate text. The content is AI-generated and may not reflect the views of the developers.")
@@ -533,65 +618,73 @@ if st.session_state.key_saved:
     st.session_state.key_saved = False
 
 # Check for saved generation after the generate button code block
-if st.session_state.has_generated:
-    # Format and display the stored generation
-    formatted_lines = []
-    for line in st.session_state.full_response.split('\n'):
-        if line.strip():
-            if line.startswith('>'):
-                formatted_lines.append(f"<div class='greentext-line'>{line}</div>")
-            else:
-                formatted_lines.append(f"<div class='greentext-line'>>{line}</div>")
-    
-    formatted_html = "\n".join(formatted_lines)
-    
-    # Display with the saved post details
-    post_html = f"""
-    <div class="greentext-container">
-        <div class="post-header">
-            Anonymous {st.session_state.current_time} <span class="post-number">{st.session_state.random_post_id}</span>
-        </div>
-        <div class="post-content">
-            {formatted_html}
-        </div>
-    </div>
-    """
+generation = st.session_state.generation
+if generation is not None:
+    # Format and display the stored generation with the saved post details
+    post_html = render_post_html(generation["text"], generation["post_time"], generation["post_id"])
     
     # This ensures it displays even after UI interactions
     if not generate_button:  # Only show if not already showing from generate button
         st.markdown(post_html, unsafe_allow_html=True)
-        st.success(f"Greentext generated successfully with {provider}!")
+        if generation["from_history"]:
+            st.info("Loaded from history - no API call made")
+        else:
+            st.success(f"Greentext generated successfully with {provider}!")
     
     # Update the download options to use session state
     st.markdown("### Download Options")
     download_format = st.selectbox(
         "Choose download format:",
-        ["Text (.txt)", "Image (.png)", "PDF (.pdf)"],
+        ["Text (.txt)", *IMAGE_DOWNLOADS, "PDF (.pdf)"],
         index=0
     )
     
-    post_info = f"Anonymous {st.session_state.current_time} {st.session_state.random_post_id}"
+    post_info = f"Anonymous {generation['post_time']} {generation['post_id']}"
+    
+    # Image and PDF bytes are only built when the download button is clicked,
+    # so reruns never export anything. The click's callable runs off the script
+    # thread and only waits for the export worker pool, which renders the post
+    # in another process; the button shows as pending until the bytes arrive.
+    # Bytes are kept in the process-wide export cache, never in the session.
+    def export_data(export_format, greentext=generation["text"], post_info=post_info):
+        def build():
+            with metrics.span("export", format=export_format):
+                return get_export_pool().export(greentext, post_info, export_format, get_export_cache())
+        return build
+    
+    # Downloads fail while the export queue is full, so say so up front
+    pool_stats = get_export_pool().stats()
+    if download_format != "Text (.txt)" and pool_stats["pending"] >= pool_stats["max_pending"]:
+        st.warning("Too many exports are being rendered right now. If the download fails, try again in a moment.")
     
     if download_format == "Text (.txt)":
         st.download_button(
             label="Download as Text File",
-            data=st.session_state.full_response,
+            data=lambda greentext=generation["text"]: greentext,
             file_name="greentext.txt",
             mime="text/plain"
         )
-    elif download_format == "Image (.png)":
-        img_bytes = convert_to_image(st.session_state.full_response, post_info)
+    elif download_format in IMAGE_DOWNLOADS:
+        image_format = IMAGE_DOWNLOADS[download_format]
         st.download_button(
             label="Download as Image",
-            data=img_bytes,
-            file_name="greentext.png",
-            mime="image/png"
+            data=export_data(image_format),
+            file_name=f"greentext.{IMAGE_FORMATS[image_format][2]}",
+            mime=IMAGE_FORMATS[image_format][1]
         )
     else:  # PDF
-        pdf_bytes = convert_to_pdf(st.session_state.full_response, post_info)
         st.download_button(
             label="Download as PDF",
-            data=pdf_bytes,
+            data=export_data("pdf"),
             file_name="greentext.pdf",
             mime="application/pdf"
-        ) 
+        )
+
+# Memory diagnostics: measure this session's state after each completed run
+if MEMORY_DEBUG:
+    run_context = get_script_run_ctx()
+    if run_context is not None:
+        session_values = {key: st.session_state[key] for key in st.session_state}
+        session_bytes = deep_sizeof(session_values)
+        session_footprints.record(run_context.session_id, session_bytes, len(session_values))
+        metrics.observe("greentext_session_state_bytes", session_bytes)
@@ -0,0 +1,181 @@
+# Export worker pool: image and PDF rendering in separate processes.
+#
+# Pillow drawing, image encoding and ReportLab layout hold the GIL, so
+# rendering in a Streamlit script thread (or a server thread) stalls every
+# other session in the process. ExportPool runs the exporters in a
+# ProcessPoolExecutor instead; callers only wait on a future, which doesn't
+# hold the GIL, and export CPU spreads across cores.
+#
+# - Workers are started with the pool and warm up in their initializer
+#   (fonts, PDF styles, one tiny post rendered in every format), so the first
+#   real job doesn't pay for imports and font loading.
+# - At most max_pending jobs are queued or running. Past that, submit()
+#   raises ExportBusy instead of queueing without bound.
+# - Callers wait at most `timeout` seconds, then get a TimeoutError. A job
+#   that timed out keeps its slot until its worker finishes it, so slow jobs
+#   still count against max_pending.
+# - Jobs submitted with the same key while one is in flight share its future.
+# - With workers=0 everything renders inline in the calling thread.
+#
+# Workers come from a forkserver (or spawn) context: the app and the server
+# run threads, which makes forking them unsafe. Those start methods re-run the
+# parent's __main__ in every child, and under Streamlit __main__ is the app
+# script itself, so workers are started behind a stand-in __main__ that
+# children leave alone (_neutral_main). Defaults come from
+# GREENTEXT_EXPORT_WORKERS (CPU count, at most 4), GREENTEXT_EXPORT_QUEUE
+# (4 jobs per worker) and GREENTEXT_EXPORT_TIMEOUT (seconds, default 30).
+
+import contextlib
+import importlib.machinery
+import os
+import sys
+import threading
+import types
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from greentext_export import export_bytes, export_key, render_export
+from greentext_metrics import metrics
+
+EXPORT_WORKERS = int(os.environ.get("GREENTEXT_EXPORT_WORKERS", min(4, os.cpu_count() or 1)))
+EXPORT_QUEUE = int(os.environ.get("GREENTEXT_EXPORT_QUEUE", 4 * max(1, EXPORT_WORKERS)))
+EXPORT_TIMEOUT = float(os.environ.get("GREENTEXT_EXPORT_TIMEOUT", "30"))
+
+# Post rendered by every worker on startup
+WARMUP_POST = (">be me\n>mfw", "Anonymous 01/01/25(Wed)12:00:00 No.123456789")
+
+
+# Raised when the export queue is full; callers should ask the user to retry
+class ExportBusy(RuntimeError):
+    pass
+
+
+# Worker initializer: load fonts and PDF styles and render one small post in
+# every format, so imports and caches are warm before the first job
+def warm_worker():
+    from greentext_export import IMAGE_FORMATS, _platypus_styles, load_fonts
+
+    load_fonts()
+    _platypus_styles()
+    for export_format in [*IMAGE_FORMATS, "pdf"]:
+        render_export(*WARMUP_POST, export_format)
+
+
+def _worker_pid():
+    return os.getpid()
+
+
+# Context manager that swaps in an empty __main__ while worker processes are
+# launched; a module spec named "__main__" tells multiprocessing to skip
+# re-running the parent's main script in the child
+@contextlib.contextmanager
+def _neutral_main():
+    main = sys.modules["__main__"]
+    neutral = types.ModuleType("__main__")
+    neutral.__spec__ = importlib.machinery.ModuleSpec("__main__", None)
+    sys.modules["__main__"] = neutral
+    try:
+        yield
+    finally:
+        if sys.modules["__main__"] is neutral:
+            sys.modules["__main__"] = main
+
+
+class ExportPool:
+    def __init__(self, workers=EXPORT_WORKERS, max_pending=EXPORT_QUEUE, timeout=EXPORT_TIMEOUT, registry=metrics):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._executor = None
+        self.rejected = 0
+        self.timeouts = 0
+        if workers:
+            self._start()
+
+    def _start(self):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self._executor = ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context(method), initializer=warm_worker
+        )
+        # Workers are spawned on demand; one no-op job each starts (and warms)
+        # all of them now, so no process is launched outside _neutral_main()
+        with _neutral_main():
+            for _ in range(self.workers):
+                self._executor.submit(_worker_pid)
+
+    # Function to start `function(*args)` in a worker and return its Future.
+    # Jobs with the same `key` share one future while it is pending.
+    def submit(self, function, *args, key=None, **labels):
+        from concurrent.futures.process import BrokenProcessPool
+
+        key = key if key is not None else object()
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            if len(self._pending) >= self.max_pending:
+                self.rejected += 1
+                self.registry.inc("greentext_export_rejected_total", **labels)
+                raise ExportBusy(f"{len(self._pending)} exports are already pending")
+            try:
+                future = self._executor.submit(function, *args)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory); replace the pool once
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._start()
+                future = self._executor.submit(function, *args)
+            self._pending[key] = future
+            self.registry.observe("greentext_export_queue_depth", len(self._pending), **labels)
+        future.add_done_callback(lambda done: self._finished(key, done))
+        return future
+
+    def _finished(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    # Function to run `function(*args)` in a worker and wait for its result
+    def run(self, function, *args, key=None, **labels):
+        if not self.workers:
+            return function(*args)
+        future = self.submit(function, *args, key=key, **labels)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            self.registry.inc("greentext_export_timeouts_total", **labels)
+            raise TimeoutError(f"Export took longer than {self.timeout:g}s") from None
+
+    # Function to get the bytes of one post in an export format, from `cache`
+    # (a greentext_cache.ExportCache) when present or rendered by a worker
+    def export(self, greentext, post_info, export_format, cache=None):
+        if not self.workers:
+            return export_bytes(greentext, post_info, export_format, cache)
+        key = export_key(greentext, post_info, export_format)
+
+        def build():
+            return self.run(render_export, greentext, post_info, export_format, key=key, format=export_format)
+
+        if cache is None:
+            return build()
+        return cache.get_or_build(key, build)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pending": len(self._pending),
+                "max_pending": self.max_pending,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,76 @@
+# Tests that callers with different API keys never share generations
+# (run with: python -m pytest)
+
+import asyncio
+
+from greentext_cache import CachedGenerator, GenerationCache, tenant_fingerprint
+from greentext_coalesce import CoalescingGenerator
+from greentext_engine import FakeGenerator
+from greentext_history import HistoryStore
+
+
+# Fake upstream that counts the streams it is asked for
+class CountingGenerator(FakeGenerator):
+    def __init__(self):
+        super().__init__(delay=0.01)
+        self.calls = 0
+
+    async def stream(self, prompt, temperature, max_tokens):
+        self.calls += 1
+        async for delta in super().stream(prompt, temperature, max_tokens):
+            yield delta
+
+
+# Function to collect one stream into a string
+async def collect(generator, prompt="usb drive", temperature=1.0):
+    return "".join([delta async for delta in generator.stream(prompt, temperature, 300)])
+
+
+def test_fingerprint_depends_on_keys_only():
+    assert tenant_fingerprint("sk-a", "sk-b") == tenant_fingerprint("sk-b", None, "sk-a")
+    assert tenant_fingerprint("sk-a") != tenant_fingerprint("sk-b")
+
+
+def test_keys_do_not_share_cache_entries():
+    # Only deterministic (temperature 0) requests are cached
+    cache = GenerationCache()
+    upstream = CountingGenerator()
+    alice = CachedGenerator(upstream, cache, tenant_fingerprint("sk-alice"))
+    bob = CachedGenerator(upstream, cache, tenant_fingerprint("sk-bob"))
+
+    asyncio.run(collect(alice, temperature=0))
+    asyncio.run(collect(bob, temperature=0))
+    assert upstream.calls == 2
+    asyncio.run(collect(alice, temperature=0))
+    assert upstream.calls == 2
+
+
+def test_keys_do_not_share_flights():
+    upstream = CountingGenerator()
+    flights = {}
+    alice = CoalescingGenerator(upstream, tenant_fingerprint("sk-alice"), flights)
+    also_alice = CoalescingGenerator(upstream, tenant_fingerprint("sk-alice"), flights)
+    bob = CoalescingGenerator(upstream, tenant_fingerprint("sk-bob"), flights)
+
+    async def run_together():
+        return await asyncio.gather(collect(alice), collect(also_alice), collect(bob))
+
+    texts = asyncio.run(run_together())
+    assert texts[0] == texts[1] == texts[2]
+    assert upstream.calls == 2
+    assert flights == {}
+
+
+def test_keys_do_not_see_each_others_history(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"))
+    alice, bob = tenant_fingerprint("sk-alice"), tenant_fingerprint("sk-bob")
+    alice_entry = store.add("usb drive", ">be alice", owner=alice)
+    bob_entry = store.add("usb drive", ">be bob", owner=bob)
+
+    assert [row["id"] for row in store.search(owners=[alice])] == [alice_entry]
+    assert [row["id"] for row in store.search("usb", owners=[bob])] == [bob_entry]
+    assert store.search(owners=[]) == []
+    assert store.get(bob_entry, owners=[alice]) is None
+    assert store.get(alice_entry, owners=[alice])["output"] == ">be alice"
+    assert not store.delete(alice_entry, owners=[bob])
+    assert len(store.search(owners=None)) == 2
@@ -0,0 +1,61 @@
+# Tests for the shared greentext line normalizer (run with: python -m pytest)
+
+import random
+
+from greentext_lines import LineParser, normalize_line, parse_lines
+
+SAMPLE = ">be me\nfind a <usb> & plug it in\n\n  >it's full of spreadsheets  \r\n>mfw\n"
+
+
+# Function to feed `text` to a fresh parser in random-sized chunks
+def parse_in_chunks(text, rng):
+    parser = LineParser()
+    streamed = []
+    position = 0
+    while position < len(text):
+        size = rng.randint(1, 8)
+        streamed.extend(parser.feed(text[position:position + size]))
+        position += size
+    closed = parser.close()
+    return streamed, closed
+
+
+def test_random_chunkings_match_whole_text():
+    rng = random.Random(0)
+    whole = list(parse_lines(SAMPLE + "trailing line"))
+    for _ in range(200):
+        streamed, closed = parse_in_chunks(SAMPLE + "trailing line", rng)
+        assert closed == whole
+        # Every line but the unterminated last one is returned by feed()
+        assert streamed == whole[:-1]
+
+
+def test_crlf_and_blank_lines():
+    lines = parse_lines(">one\r\n\r\n   \r\ntwo\r\n\n")
+    assert [line.text for line in lines] == [">one", ">two"]
+
+
+def test_lines_get_a_single_leading_marker():
+    assert normalize_line("  be me ").text == ">be me"
+    assert normalize_line(">be me").text == ">be me"
+    assert normalize_line(" \t ") is None
+
+
+def test_partial_is_the_open_last_line():
+    parser = LineParser()
+    assert parser.partial() is None
+    assert parser.feed(">be") == []
+    assert parser.partial().text == ">be"
+    assert parser.feed(" me\n") == [normalize_line(">be me")]
+    assert parser.partial() is None
+    parser.feed("mfw")
+    assert parser.partial().text == ">mfw"
+    assert parser.lines == [normalize_line(">be me")]
+    assert parser.close()[-1].text == ">mfw"
+    assert parser.partial() is None
+
+
+def test_html_is_escaped():
+    line = normalize_line("<b>tom & jerry</b> >implying")
+    assert line.text == "><b>tom & jerry</b> >implying"
+    assert line.html == "<div class='greentext-line'>&gt;&lt;b&gt;tom &amp; jerry&lt;/b&gt; &gt;implying</div>"